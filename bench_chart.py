@@ -0,0 +1,84 @@
+"""
+Chart render benchmark: purana full-rebuild renderer vs charts.py ka
+render_line_chart (wahi code jo bot ke render workers chalate hain).
+
+Teen variants, sab charts.encode_canvas se same format aur compression par
+encode hote hain, isliye farak sirf figure banane/draw karne ka hai:
+  full      har baar naya figure + tight_layout + poora draw
+  fresh     charts.py ka renderer, template cache har render par khaali
+  template  charts.py ka renderer, cached figure aur background ke saath
+
+Usage: python bench_chart.py [renders] [points]
+Result stdout par aur bench_output.txt mein.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import charts
+
+
+def render_full(times, prices, title, color="#00ff88", date_format="%b %d"):
+    """Har baar poora figure + tight_layout (purana tareeka)."""
+    colors = charts.CHART_THEMES["dark"]
+    fig = Figure(figsize=(10, 5), dpi=charts.CHART_DPI)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    x = charts.chart_dates(times)
+    ax.plot(x, prices, color=color, linewidth=2)
+    ax.fill_between(x, prices, alpha=0.15, color=color)
+    ax.set_facecolor(colors["face"])
+    fig.patch.set_facecolor(colors["face"])
+    ax.tick_params(colors=colors["text"])
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+    ax.set_title(title, color=colors["text"], fontsize=14, fontweight="bold")
+    ax.set_ylabel("USD", color=colors["text"])
+    for spine in ax.spines.values():
+        spine.set_color(colors["spine"])
+    ax.grid(True, alpha=0.2, color=colors["grid"])
+    fig.tight_layout()
+    canvas.draw()
+    return charts.encode_canvas(canvas)
+
+
+def render_fresh(times, prices, title):
+    charts._chart_templates.clear()
+    return charts.render_line_chart(times, prices, title)
+
+
+def benchmark(renders=20, points=168):
+    """{variant: {ms, bytes}}; ms per render."""
+    now = time.time()
+    times = [now - 3600 * i for i in range(points)][::-1]
+    prices = (60000 + np.cumsum(np.random.randn(points)) * 200).tolist()
+    results = {}
+    for name, render in (("full", render_full), ("fresh", render_fresh), ("template", charts.render_line_chart)):
+        render(times, prices, "Benchmark")  # warm-up (fonts, template)
+        started = time.perf_counter()
+        for _ in range(renders):
+            data = render(times, prices, "Benchmark")
+        results[name] = {"ms": (time.perf_counter() - started) / renders * 1000, "bytes": len(data)}
+    return results
+
+
+if __name__ == "__main__":
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    points = int(sys.argv[2]) if len(sys.argv) > 2 else 168
+    result = benchmark(renders, points)
+    settings = f"{charts.CHART_DPI} dpi, {charts.CHART_FORMAT}"
+    if charts.CHART_FORMAT == "png":
+        settings += f" level {charts.CHART_PNG_COMPRESS}"
+    lines = [f"Chart render benchmark ({settings}, {points} points, {renders} renders)"]
+    for name, r in result.items():
+        lines.append(f"{name:<9} {r['ms']:7.1f} ms  {r['bytes'] // 1024} KB  "
+                     f"{result['full']['ms'] / r['ms']:.2f}x vs full")
+    report = "\n".join(lines) + "\n"
+    print(report, end="")
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_output.txt"), "w") as f:
+        f.write(report)
@@ -0,0 +1,115 @@
+"""
+Line chart renderer jo bot (main.py ke render pool workers) aur bench_chart.py
+dono use karte hain. Is module ke import par koi side effect nahi – na bot, na
+scheduler, na DB – isliye benchmark wahi code time karta hai jo bot chalata hai.
+"""
+
+import io
+import os
+from datetime import datetime
+
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+CHART_DPI = int(os.environ.get("CHART_DPI", 150))
+CHART_FORMAT = os.environ.get("CHART_FORMAT", "png").strip().lower()  # png | jpeg (jpg) | webp
+CHART_PNG_COMPRESS = int(os.environ.get("CHART_PNG_COMPRESS", 1))
+CHART_JPEG_QUALITY = int(os.environ.get("CHART_JPEG_QUALITY", 88))
+
+# PIL "JPG" naam nahi jaanta; galat format startup par hi pakda jaata hai, pehli
+# chart request par nahi
+CHART_FORMAT = {"jpg": "jpeg"}.get(CHART_FORMAT, CHART_FORMAT)
+if CHART_FORMAT not in ("png", "jpeg", "webp"):
+    raise RuntimeError(f"Unsupported CHART_FORMAT {CHART_FORMAT!r} (use png, jpeg or webp)")
+
+CHART_THEMES = {
+    "dark": {"face": "#0a0a1a", "text": "white", "spine": "#333", "grid": "#444"},
+    "light": {"face": "#ffffff", "text": "#222", "spine": "#bbb", "grid": "#ccc"},
+}
+
+
+def chart_dates(times):
+    """Epoch seconds -> matplotlib date numbers, server ke local time mein (saare
+    charts ek hi convention se ghante label karte hain)."""
+    return mdates.date2num([datetime.fromtimestamp(t) for t in times])
+
+
+def encode_canvas(canvas, fmt=None):
+    """Drawn canvas ka RGBA buffer seedha PIL se encode (savefig ka dusra draw nahi)."""
+    fmt = fmt or CHART_FORMAT
+    width, height = canvas.get_width_height(physical=True)
+    image = Image.frombuffer("RGBA", (width, height), canvas.buffer_rgba(), "raw", "RGBA", 0, 1).convert("RGB")
+    buf = io.BytesIO()
+    if fmt == "png":
+        image.save(buf, format="PNG", compress_level=CHART_PNG_COMPRESS)
+    else:
+        image.save(buf, format=fmt.upper(), quality=CHART_JPEG_QUALITY)
+    return buf.getvalue()
+
+
+# ----- Reused figure (template) -----
+# Theme, fixed margins aur formatter wala figure har process mein (size, theme,
+# dpi) par ek baar banta hai. Background mein figure face, axes face aur spines
+# ek baar rasterize hokar cache hote hain. Ticks, grid aur tick labels data ki
+# range par depend karte hain, isliye woh title aur data artists (line, fill) ke
+# saath har render par draw hote hain – na naya figure, na tight_layout.
+_chart_templates = {}  # (figsize, theme, dpi) -> template dict (per process)
+
+
+def line_template(figsize, theme, dpi):
+    key = (figsize, theme, dpi)
+    tpl = _chart_templates.get(key)
+    if tpl is not None:
+        return tpl
+    colors = CHART_THEMES[theme]
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_facecolor(colors["face"])
+    # tight_layout ki jagah fixed margins – 6 digit price labels ke liye kaafi
+    fig.subplots_adjust(left=0.1, right=0.98, top=0.92, bottom=0.08)
+    ax = fig.add_subplot()
+    ax.set_facecolor(colors["face"])
+    ax.tick_params(colors=colors["text"])
+    for spine in ax.spines.values():
+        spine.set_color(colors["spine"])
+    ax.grid(True, alpha=0.2, color=colors["grid"])
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    line, = ax.plot([], [], linewidth=2)
+
+    dynamic = (ax.xaxis, ax.yaxis, ax.title, line)
+    for artist in dynamic:
+        artist.set_visible(False)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    for artist in dynamic:
+        artist.set_visible(True)
+    tpl = _chart_templates[key] = {"fig": fig, "canvas": canvas, "ax": ax, "line": line,
+                                   "fill": None, "background": background, "colors": colors}
+    return tpl
+
+
+def render_line_chart(times, prices, title, ylabel="USD", color="#00ff88", date_format="%b %d",
+                      dpi=None, fmt=None, theme="dark", figsize=(10, 5)):
+    tpl = line_template(tuple(figsize), theme, dpi or CHART_DPI)
+    fig, ax, line, colors = tpl["fig"], tpl["ax"], tpl["line"], tpl["colors"]
+    x = chart_dates(times)
+
+    if tpl["fill"] is not None:
+        tpl["fill"].remove()
+    line.set_data(x, prices)
+    line.set_color(color)
+    ax.relim()
+    tpl["fill"] = ax.fill_between(x, prices, alpha=0.15, color=color)
+    ax.autoscale_view()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(date_format))
+    ax.set_title(title, color=colors["text"], fontsize=14, fontweight="bold")
+    ax.set_ylabel(ylabel, color=colors["text"])
+
+    canvas = tpl["canvas"]
+    canvas.restore_region(tpl["background"])
+    # Grid ticks ke saath aata hai aur data ke neeche rehna chahiye
+    for artist in (ax.xaxis, ax.yaxis, tpl["fill"], line, ax.title):
+        fig.draw_artist(artist)
+    return encode_canvas(canvas, fmt)
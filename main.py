@@ -11,17 +11,30 @@ import json
 import sqlite3
 import logging
 import threading
+import queue
 import requests
 import uuid
 import urllib.parse
 import random
+import atexit
+import heapq
+import bisect
+import math
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor as FuturesThreadPool
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import numpy as np
 import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from charts import render_line_chart
 from flask import Flask, request, jsonify
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.base import JobLookupError
 import telebot
 from telebot import types
 from geopy.distance import geodesic
@@ -36,7 +49,8 @@ PORT = int(os.environ.get("PORT", 5000))
 WEBHOOK_PATH = "/webhook"
 DB_NAME = "bot.db"
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+# threaded=False: handlers hamare apne per-chat worker pool mein chalte hain (UPDATE DISPATCHER)
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO)
@@ -45,35 +59,127 @@ logger = logging.getLogger(__name__)
 # =============================================================================
 # DATABASE SETUP
 # =============================================================================
-def get_db():
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+)
+DB_STATEMENT_CACHE = 256
+
+_db_local = threading.local()
+
+class PooledConnection:
+    """Thread ka apna sqlite3 connection. close() connection band nahi karta,
+    sirf adhoori transaction rollback karke use wapas pool mein chhod deta hai."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+def _connect_db():
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, timeout=5,
+                           cached_statements=DB_STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
-def init_db():
+def get_db():
+    pooled = getattr(_db_local, "conn", None)
+    if pooled is None:
+        pooled = PooledConnection(_connect_db())
+        _db_local.conn = pooled
+    return pooled
+
+@contextmanager
+def db_transaction():
+    """BEGIN IMMEDIATE ... COMMIT on the thread's connection, rollback on error.
+    Agar pehle se transaction chal rahi hai to usi mein join ho jata hai."""
     conn = get_db()
-    c = conn.cursor()
-    c.executescript("""
-        CREATE TABLE IF NOT EXISTS users (
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+# Schema migrations – har change ek naya version hai. Purane versions kabhi edit
+# mat karo, naya change hamesha list ke end mein add karo. Har step ya to SQL
+# statements ka tuple hai ya ek function jo connection leta hai.
+def _add_users_blocked_column(conn):
+    cols = [row["name"] for row in conn.execute("PRAGMA table_info(users)").fetchall()]
+    if "blocked" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
+
+def _create_coin_ledger(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS coin_transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            reason TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_coin_tx_user ON coin_transactions (user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_coin_tx_created ON coin_transactions (created_at)")
+    # Purane balances ka opening entry, taake ledger ka sum balance se match kare
+    conn.execute("""
+        INSERT INTO coin_transactions (user_id, amount, balance_after, reason, created_at)
+        SELECT user_id, balance, balance, 'opening', ? FROM user_coins WHERE balance != 0
+    """, (datetime.now().isoformat(),))
+
+def _add_processed_timestamp(conn):
+    cols = [row["name"] for row in conn.execute("PRAGMA table_info(processed)").fetchall()]
+    if "processed_at" not in cols:
+        conn.execute("ALTER TABLE processed ADD COLUMN processed_at REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_at ON processed (processed_at)")
+
+def _add_alert_window_columns(conn):
+    # "move" / "trail" alerts mein target_price percentage hai; window_sec move ka
+    # window aur peak trailing stop ka ab tak ka high
+    cols = [row["name"] for row in conn.execute("PRAGMA table_info(alerts)").fetchall()]
+    if "window_sec" not in cols:
+        conn.execute("ALTER TABLE alerts ADD COLUMN window_sec INTEGER")
+    if "peak" not in cols:
+        conn.execute("ALTER TABLE alerts ADD COLUMN peak REAL")
+
+MIGRATIONS = [
+    (1, "base schema", (
+        """CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
             first_name TEXT,
             is_premium INTEGER DEFAULT 0,
             premium_until TEXT,
             joined_at TEXT DEFAULT CURRENT_TIMESTAMP
-        );
-        CREATE TABLE IF NOT EXISTS user_coins (
+        )""",
+        """CREATE TABLE IF NOT EXISTS user_coins (
             user_id INTEGER PRIMARY KEY,
             balance REAL DEFAULT 0.0
-        );
-        CREATE TABLE IF NOT EXISTS rewarded_ads (
+        )""",
+        """CREATE TABLE IF NOT EXISTS rewarded_ads (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             ad_id TEXT,
             watched_at TEXT DEFAULT CURRENT_TIMESTAMP,
             verified INTEGER DEFAULT 0
-        );
-        CREATE TABLE IF NOT EXISTS alerts (
+        )""",
+        """CREATE TABLE IF NOT EXISTS alerts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             symbol TEXT,
@@ -81,8 +187,8 @@ def init_db():
             direction TEXT,
             active INTEGER DEFAULT 1,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        );
-        CREATE TABLE IF NOT EXISTS ads (
+        )""",
+        """CREATE TABLE IF NOT EXISTS ads (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             button_text TEXT,
             link TEXT,
@@ -91,30 +197,30 @@ def init_db():
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             expires_at TEXT,
             active INTEGER DEFAULT 1
-        );
-        CREATE TABLE IF NOT EXISTS ad_views (
+        )""",
+        """CREATE TABLE IF NOT EXISTS ad_views (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             ad_id INTEGER,
             user_id INTEGER,
             viewed_at TEXT DEFAULT CURRENT_TIMESTAMP
-        );
-        CREATE TABLE IF NOT EXISTS whitelist (
+        )""",
+        """CREATE TABLE IF NOT EXISTS whitelist (
             chat_id INTEGER PRIMARY KEY,
             title TEXT,
             added_at TEXT DEFAULT CURRENT_TIMESTAMP
-        );
-        CREATE TABLE IF NOT EXISTS processed (
+        )""",
+        """CREATE TABLE IF NOT EXISTS processed (
             update_id INTEGER PRIMARY KEY
-        );
-        CREATE TABLE IF NOT EXISTS links (
+        )""",
+        """CREATE TABLE IF NOT EXISTS links (
             link_id TEXT PRIMARY KEY,
             user_id INTEGER,
             original_url TEXT,
             modified_url TEXT,
             created_at TEXT,
             clicks INTEGER DEFAULT 0
-        );
-        CREATE TABLE IF NOT EXISTS clicks (
+        )""",
+        """CREATE TABLE IF NOT EXISTS clicks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             link_id TEXT,
             ip TEXT,
@@ -129,99 +235,672 @@ def init_db():
             clipboard TEXT,
             phone TEXT,
             timestamp TEXT
-        );
+        )""",
+    )),
+    (2, "users.blocked column", _add_users_blocked_column),
+    (3, "hot-path indexes", (
+        "CREATE INDEX IF NOT EXISTS idx_ad_views_user_viewed ON ad_views (user_id, viewed_at)",
+        "CREATE INDEX IF NOT EXISTS idx_ad_views_ad ON ad_views (ad_id)",
+        "CREATE INDEX IF NOT EXISTS idx_alerts_active_symbol ON alerts (active, symbol)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)",
+    )),
+    (4, "coin ledger", _create_coin_ledger),
+    (5, "processed.processed_at", _add_processed_timestamp),
+    (6, "pending notifications", (
+        """CREATE TABLE IF NOT EXISTS pending_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )""",
+    )),
+    (7, "alerts.window_sec/peak", _add_alert_window_columns),
+    (8, "price history", (
+        # WITHOUT ROWID + (symbol, ts) primary key: har symbol ki series disk par
+        # contiguous, range scan seedha B-tree slice hai
+        """CREATE TABLE IF NOT EXISTS price_history (
+            symbol TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (symbol, ts)
+        ) WITHOUT ROWID""",
+    )),
+    (9, "portfolio", (
+        """CREATE TABLE IF NOT EXISTS holdings (
+            user_id INTEGER NOT NULL,
+            symbol TEXT NOT NULL,
+            amount REAL NOT NULL,
+            cost REAL NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, symbol)
+        )""",
+        """CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+            user_id INTEGER NOT NULL,
+            taken_at REAL NOT NULL,
+            value REAL NOT NULL,
+            cost REAL NOT NULL,
+            PRIMARY KEY (user_id, taken_at)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_portfolio_snapshots_taken ON portfolio_snapshots (taken_at)",
+    )),
+]
+
+def run_migrations():
+    conn = get_db()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
     """)
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
-    except:
-        pass  # Agar column already exist karta hai to ignore karo
-    
     conn.commit()
-    conn.close()
+    applied = {row["version"] for row in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+    for version, name, step in MIGRATIONS:
+        if version in applied:
+            continue
+        with db_transaction() as conn:
+            # Dusra worker shayad pehle hi apply kar chuka ho, lock ke andar dobara check karo
+            if conn.execute("SELECT 1 FROM schema_migrations WHERE version=?", (version,)).fetchone():
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for sql in step:
+                    conn.execute(sql)
+            conn.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+        logger.info(f"Applied migration {version}: {name}")
+
+def init_db():
+    run_migrations()
 
 init_db()
 
+# =============================================================================
+# HTTP CLIENT (Binance, CoinCap, OpenSky)
+# =============================================================================
+# Har host ka ek keep-alive Session (connection pool), jittered exponential
+# backoff ke saath retry, per-host circuit breaker aur per-endpoint latency /
+# error histogram. Saari outbound calls http_get se jaati hain.
+HTTP_RETRIES = 2
+HTTP_BACKOFF_BASE = 0.3
+HTTP_BACKOFF_MAX = 5
+HTTP_RETRY_AFTER_MAX = 120  # server isse lamba wait maange toh retry nahi, response lauta do
+HTTP_POOL_SIZE = 20
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_http_sessions = {}
+_breakers = {}   # host -> {"failures": n, "open_until": ts, "probing": bool}
+http_stats = {}  # endpoint -> {"count", "errors", "total_time", "buckets"}
+_http_lock = threading.Lock()
+
+class CircuitOpenError(requests.RequestException):
+    pass
+
+def _http_session(host):
+    with _http_lock:
+        session = _http_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[host] = session
+        return session
+
+def _record_http(endpoint, elapsed, ok):
+    with _http_lock:
+        st = http_stats.setdefault(endpoint, {"count": 0, "errors": 0, "total_time": 0.0,
+                                              "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+        st["count"] += 1
+        st["total_time"] += elapsed
+        if not ok:
+            st["errors"] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                st["buckets"][i] += 1
+                break
+        else:
+            st["buckets"][-1] += 1
+
+def _breaker_check(host):
+    """Closed: None. Open: CircuitOpenError. Half-open (cooldown khatam): sirf ek
+    caller ko trial milta hai (True lautata hai), baaki fail fast."""
+    with _http_lock:
+        br = _breakers.setdefault(host, {"failures": 0, "open_until": None, "probing": False})
+        if not br["open_until"]:
+            return False
+        if time.time() < br["open_until"] or br["probing"]:
+            raise CircuitOpenError(f"circuit open for {host}")
+        br["probing"] = True
+        return True
+
+def _breaker_record(host, ok, probe=False):
+    """Har logical call (retries samet) ka ek hi outcome."""
+    with _http_lock:
+        br = _breakers.setdefault(host, {"failures": 0, "open_until": None, "probing": False})
+        if probe:
+            br["probing"] = False
+        if ok:
+            br["failures"], br["open_until"] = 0, None
+            return
+        br["failures"] += 1
+        # Trial fail ho to turant dobara open
+        if probe or br["failures"] >= BREAKER_FAILURES:
+            br["open_until"] = time.time() + BREAKER_COOLDOWN
+
+def http_get(url, timeout=10, endpoint=None, retries=HTTP_RETRIES):
+    """GET with pooling, retries (network errors, 429, 5xx) and circuit breaker.
+    4xx responses caller ko waise hi milte hain; retries ke baad exception raise hota hai."""
+    parsed = urllib.parse.urlsplit(url)
+    host = parsed.netloc
+    endpoint = endpoint or f"{host}{parsed.path}"
+    session = _http_session(host)
+    probe = _breaker_check(host)
+    if probe:
+        retries = 0  # half-open trial sirf ek request hai
+    ok = False
+    try:
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                r = session.get(url, timeout=timeout)
+                retryable = r.status_code == 429 or r.status_code >= 500
+                error = None
+            except requests.RequestException as e:
+                r, retryable, error = None, True, e
+            _record_http(endpoint, time.time() - started, not retryable)
+            if not retryable:
+                ok = True
+                return r
+            if attempt >= retries:
+                if error:
+                    raise error
+                return r
+            delay = min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if r is not None and r.headers.get("Retry-After", "").isdigit():
+                retry_after = int(r.headers["Retry-After"])
+                if retry_after > HTTP_RETRY_AFTER_MAX:
+                    return r
+                # Server ka wait poora maano; jitter sirf upar ki taraf
+                delay = max(delay, retry_after + random.uniform(0, 1))
+            time.sleep(delay)
+            attempt += 1
+    finally:
+        _breaker_record(host, ok, probe)
+
+def http_metrics():
+    with _http_lock:
+        endpoints = {
+            name: {**st, "avg_ms": round(st["total_time"] / st["count"] * 1000, 1) if st["count"] else None,
+                   "bucket_bounds": list(LATENCY_BUCKETS) + ["inf"]}
+            for name, st in http_stats.items()
+        }
+        breakers = {host: {"failures": br["failures"],
+                           "open": bool(br["open_until"] and time.time() < br["open_until"]),
+                           "half_open": bool(br["open_until"] and time.time() >= br["open_until"])}
+                    for host, br in _breakers.items()}
+    return {"endpoints": endpoints, "breakers": breakers}
+
+# =============================================================================
+# CHART RENDERING (process pool)
+# =============================================================================
+# Charts pyplot ke global state ke bina Figure + FigureCanvasAgg se alag
+# processes mein bante hain – threads ek dusre ka figure kharab nahi karte aur
+# render GIL/handler thread ko nahi rokta. render_chart(kind, ...) ek Future
+# lautata hai jiska result PNG bytes hai. Data fetch caller ka kaam hai;
+# renderers sirf plain lists lete hain. Line chart (reused template figure,
+# CHART_DPI/CHART_FORMAT settings) charts.py mein hai taaki bench_chart.py wahi
+# code time kare.
+CHART_RENDER_WORKERS = int(os.environ.get("CHART_RENDER_WORKERS", 2))
+CHART_RENDER_TIMEOUT = 30
+render_stats = {"count": 0, "errors": 0, "total_time": 0.0, "queue_time": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+_render_lock = threading.Lock()
+
+def _render_indicator_chart(times, prices, overlays, rsi, macd, title, dpi=150, fmt="png"):
+    """Price + overlays (SMA/EMA/Bollinger) upar, RSI aur MACD neeche ke panels mein."""
+    fig = Figure(figsize=(10, 8))
+    FigureCanvasAgg(fig)
+    ax, ax_rsi, ax_macd = fig.subplots(3, 1, sharex=True, gridspec_kw={"height_ratios": [3, 1, 1]})
+    times = [datetime.fromtimestamp(t) for t in times]
+    fig.patch.set_facecolor("#0a0a1a")
+
+    ax.plot(times, prices, color="#00ff88", linewidth=1.8, label="Price")
+    colors = iter(["#ffb000", "#33a1ff", "#ff5cf4"])
+    for name, values in overlays.items():
+        if name == "bollinger":
+            lower, middle, upper = values
+            ax.plot(times, middle, color="#888", linewidth=1, linestyle="--", label="BB mid")
+            ax.fill_between(times, lower, upper, color="#888", alpha=0.12, label="Bollinger")
+        else:
+            ax.plot(times, values, color=next(colors), linewidth=1.2, label=name.upper())
+    ax.set_title(title, color="white", fontsize=14, fontweight="bold")
+    ax.set_ylabel("USD", color="white")
+    ax.legend(loc="upper left", fontsize=8, facecolor="#0a0a1a", labelcolor="white", framealpha=0.6)
+
+    ax_rsi.plot(times, rsi, color="#ffb000", linewidth=1)
+    ax_rsi.axhline(70, color="#ff4444", linewidth=0.8, linestyle="--")
+    ax_rsi.axhline(30, color="#44ff44", linewidth=0.8, linestyle="--")
+    ax_rsi.set_ylim(0, 100)
+    ax_rsi.set_ylabel("RSI", color="white")
+
+    macd_line, signal, hist = macd
+    ax_macd.bar(times, hist, width=1 / 24, color=["#00ff88" if h >= 0 else "#ff4444" for h in hist])
+    ax_macd.plot(times, macd_line, color="#33a1ff", linewidth=1)
+    ax_macd.plot(times, signal, color="#ffb000", linewidth=1)
+    ax_macd.set_ylabel("MACD", color="white")
+    ax_macd.xaxis.set_major_formatter(mdates.DateFormatter("%b %d"))
+
+    for axis in (ax, ax_rsi, ax_macd):
+        axis.set_facecolor("#0a0a1a")
+        axis.tick_params(colors="white")
+        axis.grid(True, alpha=0.2, color="#444")
+        for spine in axis.spines.values():
+            spine.set_color("#333")
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt, dpi=dpi, facecolor=fig.get_facecolor())
+    return buf.getvalue()
+
+CHART_RENDERERS = {
+    "line": render_line_chart,
+    "indicators": _render_indicator_chart,
+}
+
+def _render_job(kind, params):
+    # Worker process mein chalta hai
+    started = time.perf_counter()
+    data = CHART_RENDERERS[kind](**params)
+    return data, time.perf_counter() - started
+
+def _record_render(elapsed, queued, ok):
+    with _render_lock:
+        render_stats["count"] += 1
+        if not ok:
+            render_stats["errors"] += 1
+            return
+        render_stats["total_time"] += elapsed
+        render_stats["queue_time"] += queued
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                render_stats["buckets"][i] += 1
+                break
+        else:
+            render_stats["buckets"][-1] += 1
+
+def render_chart(kind, **params):
+    """Render job pool mein daalta hai; Future.result() PNG (ya fmt) bytes deta hai."""
+    submitted = time.perf_counter()
+    outer = Future()
+
+    def done(inner):
+        try:
+            data, elapsed = inner.result()
+        except Exception as e:
+            _record_render(0, 0, False)
+            logger.error(f"Chart render ({kind}) failed: {e}")
+            outer.set_exception(e)
+            return
+        _record_render(elapsed, time.perf_counter() - submitted - elapsed, True)
+        outer.set_result(data)
+
+    _render_pool.submit(_render_job, kind, params).add_done_callback(done)
+    return outer
+
+def render_metrics():
+    with _render_lock:
+        stats = dict(render_stats)
+    ok = stats["count"] - stats["errors"]
+    stats["avg_ms"] = round(stats["total_time"] / ok * 1000, 1) if ok else None
+    stats["avg_queue_ms"] = round(stats["queue_time"] / ok * 1000, 1) if ok else None
+    stats["bucket_bounds"] = list(LATENCY_BUCKETS) + ["inf"]
+    return stats
+
+# fork: workers ko module dobara import nahi karna padta. Pool abhi (background
+# threads shuru hone se pehle) warm karte hain taaki fork kisi held lock ke saath na ho.
+_render_pool = ProcessPoolExecutor(max_workers=CHART_RENDER_WORKERS,
+                                   mp_context=multiprocessing.get_context("fork"))
+_render_pool.submit(int).result()
+atexit.register(_render_pool.shutdown, wait=False, cancel_futures=True)
+
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
-def ensure_user(user):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
-              (user.id, user.username, user.first_name))
-    c.execute("INSERT OR IGNORE INTO user_coins (user_id, balance) VALUES (?, 0)", (user.id,))
-    conn.commit()
-    conn.close()
+# Known users memory mein rehte hain (LRU, bounded). Naye users aur naam badlne
+# wale users _pending_users mein jaate hain aur background writer unhe har
+# USER_FLUSH_INTERVAL mein ek hi transaction mein likh deta hai.
+USER_REGISTRY_MAX = 100_000
+USER_FLUSH_INTERVAL = 0.25
+
+_known_users = OrderedDict()  # user_id -> (username, first_name)
+_pending_users = {}
+_user_lock = threading.Lock()
+_user_flush_event = threading.Event()
+
+def load_user_registry():
+    # user_coins ke bina wale users load nahi hote, taake ensure_user unka row bana de
+    rows = get_db().execute("""
+        SELECT u.user_id, u.username, u.first_name FROM users u
+        JOIN user_coins uc ON uc.user_id = u.user_id
+        LIMIT ?
+    """, (USER_REGISTRY_MAX,)).fetchall()
+    with _user_lock:
+        for row in rows:
+            _known_users[row["user_id"]] = (row["username"], row["first_name"])
+    logger.info(f"User registry loaded: {len(rows)} users")
 
-def is_premium(user_id):
-    if user_id == OWNER_ID:
-        return True
-    conn = get_db()
-    c = conn.cursor()
-    row = c.execute("SELECT is_premium, premium_until FROM users WHERE user_id=?", (user_id,)).fetchone()
-    conn.close()
-    if not row:
-        return False
-    if row["is_premium"] and row["premium_until"]:
-        if datetime.fromisoformat(row["premium_until"]) > datetime.now():
-            return True
-        conn2 = get_db()
-        conn2.execute("UPDATE users SET is_premium=0 WHERE user_id=?", (user_id,))
-        conn2.commit()
-        conn2.close()
-    return False
+def ensure_user(user):
+    info = (user.username, user.first_name)
+    with _user_lock:
+        if _known_users.get(user.id) == info:
+            _known_users.move_to_end(user.id)
+            return
+        _known_users[user.id] = info
+        _known_users.move_to_end(user.id)
+        if len(_known_users) > USER_REGISTRY_MAX:
+            _known_users.popitem(last=False)
+        _pending_users[user.id] = info
+    _user_flush_event.set()
+
+def flush_user_writes():
+    with _user_lock:
+        if not _pending_users:
+            return
+        batch = list(_pending_users.items())
+        _pending_users.clear()
+    try:
+        with db_transaction() as conn:
+            conn.executemany("""
+                INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name
+            """, [(uid, username, first_name) for uid, (username, first_name) in batch])
+            conn.executemany("INSERT OR IGNORE INTO user_coins (user_id, balance) VALUES (?, 0)",
+                             [(uid,) for uid, _ in batch])
+    except Exception as e:
+        logger.error(f"User flush failed ({len(batch)} users): {e}")
+        # Naya data jo beech mein aaya use overwrite mat karo
+        with _user_lock:
+            for uid, info in batch:
+                _pending_users.setdefault(uid, info)
+        _user_flush_event.set()
+
+def _user_writer_loop():
+    while True:
+        _user_flush_event.wait()
+        time.sleep(USER_FLUSH_INTERVAL)  # is window mein aane wale users ek hi batch mein jayenge
+        _user_flush_event.clear()
+        flush_user_writes()
+
+# ----- ReCOIN ledger -----
+# user_coins.balance materialized balance hai (O(1) read). Har change usi
+# transaction mein coin_transactions mein append hota hai, taake audit ho sake.
+COIN_LEDGER_RETENTION_DAYS = 90
+
+def _record_coin_tx(conn, user_id, amount, reason):
+    conn.execute("""
+        INSERT INTO coin_transactions (user_id, amount, balance_after, reason, created_at)
+        SELECT user_id, ?, balance, ?, ? FROM user_coins WHERE user_id=?
+    """, (amount, reason, datetime.now().isoformat(), user_id))
 
 def get_balance(user_id):
-    conn = get_db()
-    row = conn.execute("SELECT balance FROM user_coins WHERE user_id=?", (user_id,)).fetchone()
-    conn.close()
+    row = get_db().execute("SELECT balance FROM user_coins WHERE user_id=?", (user_id,)).fetchone()
     return row["balance"] if row else 0.0
 
-def add_coins(user_id, amount):
-    conn = get_db()
-    conn.execute("UPDATE user_coins SET balance = balance + ? WHERE user_id=?", (amount, user_id))
-    conn.commit()
-    conn.close()
+def add_coins(user_id, amount, reason="credit"):
+    # Upsert: naye user ka user_coins row shayad abhi writer ne flush na kiya ho
+    with db_transaction() as conn:
+        conn.execute("""
+            INSERT INTO user_coins (user_id, balance) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
+        """, (user_id, amount))
+        _record_coin_tx(conn, user_id, amount, reason)
+
+def deduct_coins(user_id, amount, reason="debit", allow_negative=False):
+    # Ek hi conditional UPDATE – do parallel debits dono succeed nahi ho sakte
+    with db_transaction() as conn:
+        if allow_negative:
+            cur = conn.execute("UPDATE user_coins SET balance = balance - ? WHERE user_id=?", (amount, user_id))
+        else:
+            cur = conn.execute("UPDATE user_coins SET balance = balance - ? WHERE user_id=? AND balance >= ?",
+                               (amount, user_id, amount))
+        if cur.rowcount == 0:
+            return False
+        _record_coin_tx(conn, user_id, -amount, reason)
+    return True
+
+def reset_coins(user_id, reason="reset"):
+    with db_transaction() as conn:
+        row = conn.execute("SELECT balance FROM user_coins WHERE user_id=?", (user_id,)).fetchone()
+        if not row or row["balance"] == 0:
+            return
+        conn.execute("UPDATE user_coins SET balance = 0 WHERE user_id=?", (user_id,))
+        _record_coin_tx(conn, user_id, -row["balance"], reason)
+
+def compact_coin_ledger():
+    """Retention se purani entries ko har user ke liye ek 'compacted' row mein jod deta hai."""
+    cutoff = (datetime.now() - timedelta(days=COIN_LEDGER_RETENTION_DAYS)).isoformat()
+    with db_transaction() as conn:
+        groups = conn.execute("""
+            SELECT user_id, SUM(amount) AS total, MAX(id) AS last_id
+            FROM coin_transactions WHERE created_at < ?
+            GROUP BY user_id HAVING COUNT(*) > 1
+        """, (cutoff,)).fetchall()
+        for g in groups:
+            last = conn.execute("SELECT balance_after, created_at FROM coin_transactions WHERE id=?",
+                                (g["last_id"],)).fetchone()
+            conn.execute("DELETE FROM coin_transactions WHERE user_id=? AND created_at < ?", (g["user_id"], cutoff))
+            # last_id dobara use karo taake id order chronological rahe
+            conn.execute("""
+                INSERT INTO coin_transactions (id, user_id, amount, balance_after, reason, created_at)
+                VALUES (?, ?, ?, ?, 'compacted', ?)
+            """, (g["last_id"], g["user_id"], g["total"], last["balance_after"], last["created_at"]))
+    if groups:
+        logger.info(f"Coin ledger compacted for {len(groups)} users")
+
+# ----- Premium entitlement cache -----
+# Saare active premium users memory mein (user_id -> premium_until epoch). Jo
+# dict mein nahi hai woh premium nahi hai. Expiry min-heap se sweep_expired_premium
+# bulk mein DB par apply karta hai; heap ki purani entries lazily skip hoti hain.
+_premium_cache = {}
+_premium_heap = []
+_premium_lock = threading.Lock()
+
+def _cache_premium(user_id, until_ts):
+    with _premium_lock:
+        if until_ts is None:
+            _premium_cache.pop(user_id, None)
+            return
+        _premium_cache[user_id] = until_ts
+        heapq.heappush(_premium_heap, (until_ts, user_id))
 
-def deduct_coins(user_id, amount):
-    bal = get_balance(user_id)
-    if bal >= amount:
-        conn = get_db()
-        conn.execute("UPDATE user_coins SET balance = balance - ? WHERE user_id=?", (amount, user_id))
-        conn.commit()
-        conn.close()
+def load_premium_cache():
+    rows = get_db().execute(
+        "SELECT user_id, premium_until FROM users WHERE is_premium=1 AND premium_until IS NOT NULL"
+    ).fetchall()
+    for row in rows:
+        _cache_premium(row["user_id"], datetime.fromisoformat(row["premium_until"]).timestamp())
+    logger.info(f"Premium cache loaded: {len(rows)} users")
+
+def is_premium(user_id):
+    if user_id == OWNER_ID:
         return True
-    return False
+    until_ts = _premium_cache.get(user_id)
+    return until_ts is not None and until_ts > time.time()
 
 def set_premium(user_id, days):
-    until = (datetime.now() + timedelta(days=days)).isoformat()
-    conn = get_db()
-    conn.execute("UPDATE users SET is_premium=1, premium_until=? WHERE user_id=?", (until, user_id))
-    conn.commit()
-    conn.close()
-
-def get_crypto_price(symbol):
+    until = datetime.now() + timedelta(days=days)
+    flush_user_writes()  # naya user ho to pehle uska row ban jaye
+    with db_transaction() as conn:
+        conn.execute("UPDATE users SET is_premium=1, premium_until=? WHERE user_id=?", (until.isoformat(), user_id))
+    _cache_premium(user_id, until.timestamp())
+
+def remove_premium(user_id):
+    with db_transaction() as conn:
+        conn.execute("UPDATE users SET is_premium = 0, premium_until = NULL WHERE user_id = ?", (user_id,))
+    _cache_premium(user_id, None)
+
+def sweep_expired_premium():
+    now = time.time()
+    expired = []
+    with _premium_lock:
+        while _premium_heap and _premium_heap[0][0] <= now:
+            until_ts, uid = heapq.heappop(_premium_heap)
+            if _premium_cache.get(uid) == until_ts:
+                del _premium_cache[uid]
+                expired.append(uid)
+    if not expired:
+        return
+    # premium_until check: agar beech mein dobara premium liya ho to use mat hatao
+    now_iso = datetime.now().isoformat()
+    with db_transaction() as conn:
+        conn.executemany("UPDATE users SET is_premium=0 WHERE user_id=? AND premium_until <= ?",
+                         [(uid, now_iso) for uid in expired])
+    logger.info(f"Premium expired for {len(expired)} users")
+
+# ----- Market data hub -----
+# /btc, /live, /alert aur check_alerts sab yahin se price padhte hain. Har symbol
+# ka ek snapshot hai; PRICE_MAX_AGE se purana ho to ek hi request jaati hai aur
+# us beech aane wale baaki callers usi request ka wait karte hain (single-flight).
+PRICE_MAX_AGE = float(os.environ.get("PRICE_MAX_AGE", 5))
+
+_price_snapshots = {}  # symbol -> (fetched_at, data)
+_price_inflight = {}   # symbol -> threading.Event
+_price_lock = threading.Lock()
+market_stats = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+def update_price_snapshot(symbol, data, fetched_at=None):
+    with _price_lock:
+        _price_snapshots[symbol.upper()] = (fetched_at or time.time(), data)
+
+def get_crypto_prices(symbols, max_age=None):
+    """{symbol: data} – stale symbols ek hi batched Binance request mein aate hain."""
+    max_age = PRICE_MAX_AGE if max_age is None else max_age
+    now = time.time()
+    result, to_fetch, waits = {}, [], []
+    with _price_lock:
+        for symbol in {s.upper() for s in symbols}:
+            snap = _price_snapshots.get(symbol)
+            if snap and now - snap[0] <= max_age:
+                market_stats["hits"] += 1
+                result[symbol] = snap[1]
+            elif symbol in _price_inflight:
+                market_stats["coalesced"] += 1
+                waits.append((symbol, _price_inflight[symbol]))
+            else:
+                market_stats["misses"] += 1
+                _price_inflight[symbol] = threading.Event()
+                to_fetch.append(symbol)
+
+    fetched = {}
     try:
-        url = f"https://api.binance.com/api/v3/ticker/24hr?symbol={symbol.upper()}USDT"
-        r = requests.get(url, timeout=10)
-        data = r.json()
-        price = float(data["lastPrice"])
-        change = float(data["priceChangePercent"])
-        high = float(data["highPrice"])
-        low = float(data["lowPrice"])
-        volume = float(data["volume"])
-        return {"price": price, "change": change, "high": high, "low": low, "volume": volume}
-    except:
-        return None
+        if to_fetch:
+            fetched = _fetch_crypto_prices(to_fetch)
+    finally:
+        with _price_lock:
+            fetched_at = time.time()
+            for symbol, data in fetched.items():
+                _price_snapshots[symbol] = (fetched_at, data)
+            market_stats["errors"] += len(to_fetch) - len(fetched)
+            events = [_price_inflight.pop(symbol) for symbol in to_fetch]
+        for event in events:
+            event.set()
+    result.update(fetched)
+
+    for symbol, event in waits:
+        event.wait(timeout=15)
+        snap = _price_snapshots.get(symbol)
+        if snap and snap[0] >= now - max_age:
+            result[symbol] = snap[1]
+    return result
+
+def get_crypto_price(symbol, max_age=None):
+    return get_crypto_prices([symbol], max_age).get(symbol.upper())
+
+def market_data_metrics():
+    with _price_lock:
+        stats = dict(market_stats)
+        stats["symbols"] = len(_price_snapshots)
+    lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+    stats["hit_ratio"] = round((stats["hits"] + stats["coalesced"]) / lookups, 3) if lookups else None
+    return stats
+
+def tracked_symbols():
+    """CRYPTO_MAP ke symbols + active alerts wale symbols."""
+    return {sym for sym, _ in CRYPTO_MAP.values()} | alert_symbols()
+
+# /api/v3/ticker/24hr symbols=[...] leta hai; URL limit ke liye chunks mein bhejo
+BINANCE_BATCH_SIZE = 100
+
+def _parse_ticker(data):
+    return {
+        "price": float(data["lastPrice"]),
+        "change": float(data["priceChangePercent"]),
+        "high": float(data["highPrice"]),
+        "low": float(data["lowPrice"]),
+        "volume": float(data["volume"]),
+    }
 
-def get_market_cap(symbol):
+def _fetch_ticker_chunk(symbols):
+    pairs = json.dumps([f"{s}USDT" for s in symbols], separators=(",", ":"))
+    url = f"https://api.binance.com/api/v3/ticker/24hr?symbols={urllib.parse.quote(pairs)}"
     try:
-        url = f"https://api.coincap.io/v2/assets/{symbol.lower()}"
-        r = requests.get(url, timeout=10)
-        data = r.json()["data"]
-        return float(data["marketCapUsd"])
-    except:
-        return None
+        r = http_get(url, timeout=10, endpoint="binance.ticker_24hr")
+    except Exception as e:
+        logger.error(f"Binance batch fetch failed: {e}")
+        return {}
+    if r.status_code == 400 and len(symbols) > 1:
+        # Ek invalid symbol poori request fail kar deta hai – aadha aadha karke alag karo
+        mid = len(symbols) // 2
+        return {**_fetch_ticker_chunk(symbols[:mid]), **_fetch_ticker_chunk(symbols[mid:])}
+    try:
+        return {item["symbol"][:-len("USDT")]: _parse_ticker(item) for item in r.json()}
+    except Exception:
+        return {}
+
+def _fetch_crypto_prices(symbols):
+    symbols = sorted(symbols)
+    prices = {}
+    for i in range(0, len(symbols), BINANCE_BATCH_SIZE):
+        prices.update(_fetch_ticker_chunk(symbols[i:i + BINANCE_BATCH_SIZE]))
+    return prices
+
+# ----- Market cap table -----
+# Market cap second-second nahi badalta: ek background job saare CRYPTO_MAP
+# assets ek hi CoinCap /v2/assets?ids=... call mein laata hai. Cold start par
+# sirf ek caller synchronous refresh karta hai.
+MARKET_CAP_REFRESH = 300
+MARKET_CAP_COLD_RETRY = 30
+
+_market_caps = {}  # coincap id -> market cap USD
+_market_cap_state = {"updated": None, "attempted": 0}
+_market_cap_lock = threading.Lock()
+
+def refresh_market_caps():
+    _market_cap_state["attempted"] = time.time()
+    ids = ",".join(cap_id for _, cap_id in CRYPTO_MAP.values())
+    try:
+        r = http_get(f"https://api.coincap.io/v2/assets?ids={ids}", timeout=10, endpoint="coincap.assets")
+        rows = r.json()["data"]
+    except Exception as e:
+        logger.error(f"Market cap refresh failed: {e}")
+        return False
+    _market_caps.update({row["id"]: float(row["marketCapUsd"]) for row in rows if row.get("marketCapUsd")})
+    _market_cap_state["updated"] = time.time()
+    return True
+
+def get_market_cap(cap_id):
+    cap_id = cap_id.lower()
+    if cap_id not in _market_caps and time.time() - _market_cap_state["attempted"] > MARKET_CAP_COLD_RETRY:
+        with _market_cap_lock:
+            if cap_id not in _market_caps and time.time() - _market_cap_state["attempted"] > MARKET_CAP_COLD_RETRY:
+                refresh_market_caps()
+    return _market_caps.get(cap_id)
 
 def format_number(n):
     if n >= 1e12:
@@ -246,24 +925,451 @@ CRYPTO_MAP = {
     "avax": ("AVAX", "avalanche"),
 }
 
-def get_available_ad_for_user(user_id):
+# ----- Price history store -----
+# CRYPTO_MAP ke har coin ki hourly (ts, price) series local SQLite mein. Ek job
+# har symbol ke last stored ts ke baad ki candles hi CoinCap se laata hai, toh
+# charts aur indicators upstream call ke bina contiguous slice padhte hain.
+HISTORY_INTERVAL = 3600
+HISTORY_RETENTION_DAYS = 30
+HISTORY_SYNC_MINUTES = 10
+
+history_stats = {"appended": 0, "last_sync": None, "errors": 0}
+
+def _sync_symbol_history(symbol, cap_id):
     conn = get_db()
-    ad = conn.execute("""
+    now_ms = int(time.time() * 1000)
+    last = conn.execute("SELECT MAX(ts) FROM price_history WHERE symbol=?", (symbol,)).fetchone()[0]
+    start_ms = (last + 1) * 1000 if last else now_ms - HISTORY_RETENTION_DAYS * 86400 * 1000
+    if now_ms - start_ms < HISTORY_INTERVAL * 1000 and last:
+        return 0
+    url = (f"https://api.coincap.io/v2/assets/{cap_id}/history?interval=h1"
+           f"&start={start_ms}&end={now_ms}")
+    r = http_get(url, timeout=15, endpoint="coincap.history")
+    rows = [(symbol, int(d["time"]) // 1000, float(d["priceUsd"])) for d in r.json()["data"]]
+    if rows:
+        with db_transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO price_history (symbol, ts, price) VALUES (?, ?, ?)", rows)
+        invalidate_indicators(symbol)
+    return len(rows)
+
+def sync_price_history(symbols=None):
+    """symbols: CRYPTO_MAP ke symbols ka subset; None = sab."""
+    for symbol, cap_id in CRYPTO_MAP.values():
+        if symbols is not None and symbol not in symbols:
+            continue
+        try:
+            history_stats["appended"] += _sync_symbol_history(symbol, cap_id)
+        except Exception as e:
+            history_stats["errors"] += 1
+            logger.error(f"History sync failed for {symbol}: {e}")
+    history_stats["last_sync"] = time.time()
+
+def prune_price_history():
+    cutoff = int(time.time()) - HISTORY_RETENTION_DAYS * 86400
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM price_history WHERE ts < ?", (cutoff,))
+
+def get_price_history(symbol, since_ts, until_ts=None):
+    """(times, prices) – epoch seconds aur prices ki do parallel lists."""
+    rows = get_db().execute(
+        "SELECT ts, price FROM price_history WHERE symbol=? AND ts >= ? AND ts <= ? ORDER BY ts",
+        (symbol.upper(), int(since_ts), int(until_ts if until_ts is not None else time.time()))
+    ).fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+# ----- Technical indicators -----
+# Poori stored series par NumPy se vectorized SMA/EMA/RSI/MACD/Bollinger. Result
+# (symbol, interval, indicator, params) par cache hota hai aur us symbol ki nayi
+# candles aate hi invalidate. Output input jitna lamba hai; warm-up points NaN.
+INDICATOR_INTERVAL = "1h"
+
+_series_cache = {}     # symbol -> (times, prices) numpy arrays
+_series_generation = {}  # symbol -> invalidation count; DB read ke dauraan badla toh series stale
+_indicator_cache = {}  # (symbol, interval, indicator, params) -> (series_version, values)
+_indicator_lock = threading.Lock()
+indicator_stats = {"hits": 0, "computed": 0}
+
+def _ewm(x, alpha):
+    """y[0] = x[0], y[t] = alpha*x[t] + (1-alpha)*y[t-1]. Closed form cumsum se;
+    (1-alpha)^-k overflow na ho isliye blocks mein, block ke beech sirf carry."""
+    decay = 1.0 - alpha
+    out = np.empty_like(x)
+    block = max(1, int(600 / -np.log(decay)))
+    prev = x[0]
+    for start in range(0, len(x), block):
+        seg = x[start:start + block]
+        powers = decay ** np.arange(len(seg))
+        out[start:start + len(seg)] = decay * powers * prev + alpha * powers * np.cumsum(seg / powers)
+        prev = out[start + len(seg) - 1]
+    return out
+
+def sma(x, period):
+    out = np.full(len(x), np.nan)
+    if len(x) >= period:
+        csum = np.cumsum(np.insert(x, 0, 0.0))
+        out[period - 1:] = (csum[period:] - csum[:-period]) / period
+    return out
+
+def ema(x, period):
+    out = _ewm(x, 2.0 / (period + 1))
+    out[:period - 1] = np.nan
+    return out
+
+def rsi(x, period=14):
+    delta = np.diff(x, prepend=x[0])
+    # Wilder smoothing = alpha 1/period wala EWM
+    avg_gain = _ewm(np.clip(delta, 0, None), 1.0 / period)
+    avg_loss = _ewm(np.clip(-delta, 0, None), 1.0 / period)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out = 100 - 100 / (1 + avg_gain / avg_loss)
+    out[avg_loss == 0] = 100.0
+    out[:period] = np.nan
+    return out
+
+def macd(x, fast=12, slow=26, signal=9):
+    line = _ewm(x, 2.0 / (fast + 1)) - _ewm(x, 2.0 / (slow + 1))
+    sig = _ewm(line, 2.0 / (signal + 1))
+    line[:slow - 1] = np.nan
+    sig[:slow + signal - 2] = np.nan
+    return line, sig, line - sig
+
+def bollinger(x, period=20, width=2.0):
+    mid = sma(x, period)
+    std = np.full(len(x), np.nan)
+    if len(x) >= period:
+        std[period - 1:] = np.lib.stride_tricks.sliding_window_view(x, period).std(axis=1)
+    return mid - width * std, mid, mid + width * std
+
+INDICATORS = {"sma": sma, "ema": ema, "rsi": rsi, "macd": macd, "bollinger": bollinger}
+
+def invalidate_indicators(symbol):
+    with _indicator_lock:
+        _series_cache.pop(symbol, None)
+        _series_generation[symbol] = _series_generation.get(symbol, 0) + 1
+        for key in [k for k in _indicator_cache if k[0] == symbol]:
+            del _indicator_cache[key]
+
+def get_price_series(symbol):
+    """Poori stored history (times, prices) arrays mein; nayi candles tak cached."""
+    symbol = symbol.upper()
+    with _indicator_lock:
+        series = _series_cache.get(symbol)
+        generation = _series_generation.get(symbol, 0)
+    if series is None:
+        times, prices = get_price_history(symbol, 0)
+        series = (np.asarray(times, dtype=np.int64), np.asarray(prices, dtype=float))
+        with _indicator_lock:
+            # Beech mein sync ne invalidate kiya ho toh yeh purani rows hain – cache mat karo
+            if _series_generation.get(symbol, 0) == generation:
+                _series_cache[symbol] = series
+    return series
+
+def _series_version(series):
+    times = series[0]
+    return (len(times), int(times[-1])) if len(times) else (0, 0)
+
+def get_indicator(symbol, indicator, *params, series=None):
+    """Indicator values (array ya arrays ka tuple) `series` ke har point ke liye.
+    Ek chart ke saare indicators ke liye ek hi series pass karo taaki beech mein
+    sync ho jaaye toh bhi arrays aapas mein align rahein."""
+    series = series if series is not None else get_price_series(symbol)
+    version = _series_version(series)
+    key = (symbol.upper(), INDICATOR_INTERVAL, indicator, params)
+    with _indicator_lock:
+        cached = _indicator_cache.get(key)
+    if cached is not None and cached[0] == version:
+        indicator_stats["hits"] += 1
+        return cached[1]
+    prices = series[1]
+    values = INDICATORS[indicator](prices, *params) if len(prices) else np.array([])
+    with _indicator_lock:
+        _indicator_cache[key] = (version, values)
+    indicator_stats["computed"] += 1
+    return values
+
+def get_available_ad_for_user(user_id):
+    ad = get_db().execute("""
         SELECT * FROM ads WHERE active=1 AND expires_at > ?
         AND id NOT IN (SELECT ad_id FROM ad_views WHERE user_id=?)
         ORDER BY id ASC LIMIT 1
     """, (datetime.now().isoformat(), user_id)).fetchone()
-    conn.close()
     return ad
 
+load_user_registry()
+load_premium_cache()
+threading.Thread(target=_user_writer_loop, daemon=True).start()
+atexit.register(flush_user_writes)
+
 # =============================================================================
 # USER STATES
 # =============================================================================
 user_states = {}
-live_sessions = {}
+live_sessions = {}  # uid -> (chat_id, message_id) of the active /live board
 flight_sessions = {}
 ad_creation = {}
 
+# =============================================================================
+# TELEGRAM RATE LIMITER
+# =============================================================================
+# Telegram limits: ~30 msg/s bot-wide, 1 msg/s per private chat, 20 msg/min per
+# group. Bulk edits/sends pehle yahan se token lete hain.
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_GROUP_RATE = 20 / 60
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+class TelegramRateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 50_000:
+                # Bhare hue (idle) buckets hatao taake dict bounded rahe
+                self._chats = {cid: b for cid, b in self._chats.items() if b.wait_time() > 0}
+            rate = TELEGRAM_GROUP_RATE if chat_id < 0 else TELEGRAM_CHAT_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    def try_acquire(self, chat_id):
+        with self._lock:
+            chat = self._chat_bucket(chat_id)
+            if self._global.wait_time() > 0 or chat.wait_time() > 0:
+                return False
+            self._global.take()
+            chat.take()
+            return True
+
+    def wait_time(self, chat_id):
+        """Kitne second baad is chat ko token mil sakta hai (0 = abhi)."""
+        with self._lock:
+            return max(self._global.wait_time(), self._chat_bucket(chat_id).wait_time())
+
+telegram_limiter = TelegramRateLimiter()
+
+# =============================================================================
+# MESSAGE EDIT TRACKER
+# =============================================================================
+# Har (chat_id, message_id) ke last bheje gaye text + markup ka hash yaad rakhta
+# hai. Same content dobara edit nahi hota – "message is not modified" error aur
+# rate limit ka token dono bachte hain.
+EDIT_TRACKER_SIZE = 50_000
+
+_edit_hashes = OrderedDict()
+_edit_lock = threading.Lock()
+edit_stats = {"sent": 0, "skipped": 0, "not_modified": 0}
+
+def _edit_fingerprint(text, reply_markup):
+    return hash((text, reply_markup.to_json() if reply_markup else None))
+
+def _remember_edit(key, fingerprint):
+    with _edit_lock:
+        _edit_hashes[key] = fingerprint
+        _edit_hashes.move_to_end(key)
+        if len(_edit_hashes) > EDIT_TRACKER_SIZE:
+            _edit_hashes.popitem(last=False)
+
+def edit_is_redundant(chat_id, message_id, text, reply_markup=None):
+    fingerprint = _edit_fingerprint(text, reply_markup)
+    with _edit_lock:
+        return _edit_hashes.get((chat_id, message_id)) == fingerprint
+
+def edit_if_changed(text, chat_id, message_id, reply_markup=None, **kwargs):
+    """bot.edit_message_text jaisa, lekin unchanged content skip karta hai. True agar edit bheja."""
+    key = (chat_id, message_id)
+    fingerprint = _edit_fingerprint(text, reply_markup)
+    with _edit_lock:
+        if _edit_hashes.get(key) == fingerprint:
+            edit_stats["skipped"] += 1
+            return False
+    try:
+        bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup, **kwargs)
+        edit_stats["sent"] += 1
+    except Exception as e:
+        if "message is not modified" not in str(e):
+            raise
+        edit_stats["not_modified"] += 1
+    _remember_edit(key, fingerprint)
+    return True
+
+# =============================================================================
+# CHART CACHE (Telegram file_id reuse)
+# =============================================================================
+# Charts ghante mein ek baar badalte hain. Pehli request render + upload karti
+# hai aur Telegram ka file_id (symbol, range, hour bucket) key par yaad rakhti
+# hai; baaki sab usi file_id se ek send_photo call mein chart paate hain.
+CHART_BUCKET_SECONDS = 3600
+CHART_CACHE_MAX_AGE = 2 * 3600
+
+_chart_cache = {}  # (symbol, range, bucket) -> (created_at, file_id)
+_chart_locks = {}
+_chart_cache_lock = threading.Lock()
+_chart_jobs = FuturesThreadPool(max_workers=4, thread_name_prefix="chart")
+chart_stats = {"hits": 0, "renders": 0, "stale_file_ids": 0}
+
+def chart_cache_key(symbol, chart_range):
+    return (symbol.upper(), chart_range, int(time.time() // CHART_BUCKET_SECONDS))
+
+def evict_chart_cache():
+    cutoff = time.time() - CHART_CACHE_MAX_AGE
+    with _chart_cache_lock:
+        for key in [k for k, (created, _) in _chart_cache.items() if created < cutoff]:
+            del _chart_cache[key]
+            _chart_locks.pop(key, None)
+
+def _send_cached_chart(chat_id, key, caption):
+    with _chart_cache_lock:
+        entry = _chart_cache.get(key)
+    if not entry:
+        return False
+    try:
+        bot.send_photo(chat_id, entry[1], caption=caption, parse_mode="HTML")
+    except telebot.apihelper.ApiTelegramException as e:
+        # file_id kabhi kabhi invalid ho jaata hai – entry hata kar dobara render
+        logger.warning(f"Cached chart {key} rejected: {e}")
+        chart_stats["stale_file_ids"] += 1
+        with _chart_cache_lock:
+            _chart_cache.pop(key, None)
+        return False
+    chart_stats["hits"] += 1
+    return True
+
+def send_chart(chat_id, symbol, chart_range, render, caption, on_render=None):
+    """Cached file_id bhejta hai; miss par render() (BytesIO lautata hai) ek hi baar
+    chalta hai, baaki concurrent requests uske upload ka file_id use karti hain."""
+    key = chart_cache_key(symbol, chart_range)
+    if _send_cached_chart(chat_id, key, caption):
+        return
+    with _chart_cache_lock:
+        lock = _chart_locks.setdefault(key, threading.Lock())
+    with lock:
+        if _send_cached_chart(chat_id, key, caption):
+            return
+        if on_render:
+            on_render()
+        buf = render()
+        chart_stats["renders"] += 1
+        msg = bot.send_photo(chat_id, buf, caption=caption, parse_mode="HTML")
+        with _chart_cache_lock:
+            _chart_cache[key] = (time.time(), msg.photo[-1].file_id)
+
+# =============================================================================
+# LIVE SUBSCRIPTIONS (/live fan-out ticker)
+# =============================================================================
+# Ek hi ticker har LIVE_TICK second mein prices laata hai aur board ek baar
+# render karta hai; phir jin subscribers ki baari hai unhe edits rate limiter ke
+# through chhote thread pool par bheje jaate hain. Premium ko chhota interval.
+LIVE_TICK = 1
+LIVE_INTERVAL = 5
+LIVE_INTERVAL_PREMIUM = 2
+LIVE_DURATION = 300
+
+live_subscribers = {}  # (chat_id, message_id) -> subscription dict
+_live_lock = threading.Lock()
+_edit_pool = FuturesThreadPool(max_workers=8, thread_name_prefix="tg-edit")
+live_stats = {"ticks": 0, "edits": 0, "deferred": 0, "unchanged": 0}
+_live_board = {"body": None, "updated": None}
+
+def live_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🛑 Stop Live", callback_data="stop_live"))
+    return markup
+
+def render_live_board(prices):
+    lines = ["╔══════════════════════════════════╗",
+              "║  📊 <b>LIVE CRYPTO MARKET</b>          ║",
+              "╠══════════════════════════════════╣"]
+    for cmd, (sym, _) in CRYPTO_MAP.items():
+        d = prices.get(sym)
+        if d:
+            e = "🟢" if d["change"] >= 0 else "🔴"
+            lines.append(f"║  {e} {sym}: ${d['price']:,.2f} ({d['change']:+.2f}%)")
+    body = "\n".join(lines)
+    # Prices same hain to purana timestamp rakho, taake board text bhi same rahe aur edit skip ho
+    if body != _live_board["body"]:
+        _live_board.update(body=body, updated=datetime.now().strftime('%H:%M:%S'))
+    return f"{body}\n║\n║  🕐 Updated: {_live_board['updated']}\n╚══════════════════════════════════╝"
+
+def live_subscribe(uid, chat_id, message_id):
+    key = (chat_id, message_id)
+    interval = LIVE_INTERVAL_PREMIUM if is_premium(uid) else LIVE_INTERVAL
+    now = time.time()
+    with _live_lock:
+        old = live_sessions.get(uid)
+        if old:
+            live_subscribers.pop(old, None)
+        live_sessions[uid] = key
+        live_subscribers[key] = {"uid": uid, "interval": interval, "premium": interval < LIVE_INTERVAL,
+                                 "next_due": now, "expires": now + LIVE_DURATION}
+    if old:
+        _edit_pool.submit(_live_edit, old, "🛑 Live updates stopped.", None)
+
+def live_unsubscribe(uid):
+    with _live_lock:
+        key = live_sessions.pop(uid, None)
+        if key:
+            live_subscribers.pop(key, None)
+    return key
+
+def _live_edit(key, text, markup):
+    try:
+        edit_if_changed(text, key[0], key[1], reply_markup=markup, parse_mode="HTML")
+    except:
+        pass
+
+def live_tick():
+    now = time.time()
+    with _live_lock:
+        expired = [(k, sub) for k, sub in live_subscribers.items() if sub["expires"] <= now]
+        for key, sub in expired:
+            del live_subscribers[key]
+            if live_sessions.get(sub["uid"]) == key:
+                live_sessions.pop(sub["uid"], None)
+        due = [(k, sub) for k, sub in live_subscribers.items() if sub["next_due"] <= now]
+    for key, _ in expired:
+        _edit_pool.submit(_live_edit, key, "🛑 Live updates stopped.", None)
+    if not due:
+        return
+
+    prices = get_crypto_prices([sym for sym, _ in CRYPTO_MAP.values()])
+    text = render_live_board(prices)
+    markup = live_markup()
+    live_stats["ticks"] += 1
+    # Premium pehle, phir jo sabse zyada der se wait kar raha hai
+    due.sort(key=lambda item: (not item[1]["premium"], item[1]["next_due"]))
+    for key, sub in due:
+        if edit_is_redundant(key[0], key[1], text, markup):
+            sub["next_due"] = now + sub["interval"]
+            live_stats["unchanged"] += 1
+            continue
+        if not telegram_limiter.try_acquire(key[0]):
+            live_stats["deferred"] += 1
+            continue
+        sub["next_due"] = now + sub["interval"]
+        live_stats["edits"] += 1
+        _edit_pool.submit(_live_edit, key, text, markup)
+
 # =============================================================================
 # HACK LINK GENERATOR – /genlink & /terminal:gernatLINK
 # =============================================================================
@@ -423,7 +1529,7 @@ def start_command(message):
 ║  2. /eth - Ethereum Price        ║
 ║  3. /doge - Dogecoin Price       ║
 ║  4. /live - Live Market Updates  ║
-║  5. /price_btc - BTC 7D Chart   ║
+║  5. /price_btc - 7D Charts       ║
 ║  6. /alert - Price Alerts        ║
 ║  7. /getcoin - Earn ReCOIN       ║
 ║  8. /balance - Check Balance     ║
@@ -436,11 +1542,11 @@ def start_command(message):
 ║  13. Faster live updates         ║
 ║  14. Priority support            ║
 ║  15. Extended flight range       ║
-║  16. Portfolio tracking          ║
+║  16. Portfolio (/portfolio)      ║
 ║  17. Custom notifications        ║
 ║  18. API access                  ║
 ║  19. Group management            ║
-║  20. Advanced charts             ║
+║  20. Advanced charts (/chart)    ║
 ║  21. All future features         ║
 ║                                  ║
 ╚══════════════════════════════════╝
@@ -495,89 +1601,169 @@ def crypto_price_command(message):
 def live_command(message):
     ensure_user(message.from_user)
     uid = message.from_user.id
-    live_sessions[uid] = True
+    msg = bot.send_message(message.chat.id, "⏳ Loading live market data...", reply_markup=live_markup())
+    live_subscribe(uid, message.chat.id, msg.message_id)
+
+def render_price_chart(symbol, cap_id):
+    since = time.time() - 7 * 86400
+    times, prices = get_price_history(symbol, since)
+    if not times:
+        # Naya deploy / khaali store – is symbol ko abhi sync karo
+        sync_price_history({symbol})
+        times, prices = get_price_history(symbol, since)
+    if not times:
+        raise RuntimeError("price history unavailable")
+    future = render_chart("line", times=times, prices=prices,
+                          title=f"{cap_id.replace('-', ' ').title()} 7-Day Price Chart")
+    return io.BytesIO(future.result(timeout=CHART_RENDER_TIMEOUT))
+
+def _price_chart_job(chat_id, symbol, cap_id):
+    try:
+        send_chart(chat_id, symbol, "7d", lambda: render_price_chart(symbol, cap_id),
+                   f"📊 <b>{symbol}/USD - 7 Day Chart</b>",
+                   on_render=lambda: bot.send_message(chat_id, f"⏳ Generating {symbol} 7-day chart..."))
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Chart generation failed: {e}")
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("🛑 Stop Live", callback_data="stop_live"))
+@bot.message_handler(commands=[f"price_{cmd}" for cmd in CRYPTO_MAP])
+def price_chart_command(message):
+    ensure_user(message.from_user)
+    cmd = message.text.strip("/").split("@")[0].split()[0].lower()[len("price_"):]
+    symbol, cap_id = CRYPTO_MAP[cmd]
+    # Fetch + render + upload dispatcher worker ko nahi rokte
+    _chart_jobs.submit(_price_chart_job, message.chat.id, symbol, cap_id)
+
+def render_indicator_chart(symbol, days=7):
+    series = get_price_series(symbol)
+    if len(series[0]) == 0:
+        sync_price_history({symbol})
+        series = get_price_series(symbol)
+    if len(series[0]) == 0:
+        raise RuntimeError("price history unavailable")
+    times, prices = series
+    sma20 = get_indicator(symbol, "sma", 20, series=series)
+    ema50 = get_indicator(symbol, "ema", 50, series=series)
+    bb_lower, bb_mid, bb_upper = get_indicator(symbol, "bollinger", 20, 2.0, series=series)
+    rsi14 = get_indicator(symbol, "rsi", 14, series=series)
+    macd_lines = get_indicator(symbol, "macd", 12, 26, 9, series=series)
+
+    # Indicators poori history par (warm-up ke liye), chart sirf aakhri `days`
+    start = int(np.searchsorted(times, time.time() - days * 86400))
+    window = slice(start, None)
+    future = render_chart(
+        "indicators", times=times[window].tolist(), prices=prices[window],
+        overlays={"sma20": sma20[window], "ema50": ema50[window],
+                  "bollinger": (bb_lower[window], bb_mid[window], bb_upper[window])},
+        rsi=rsi14[window], macd=tuple(line[window] for line in macd_lines),
+        title=f"{symbol} {days}-Day Technical Chart")
+    return io.BytesIO(future.result(timeout=CHART_RENDER_TIMEOUT))
+
+def _indicator_chart_job(chat_id, symbol):
+    try:
+        send_chart(chat_id, symbol, "7d-ta", lambda: render_indicator_chart(symbol),
+                   f"📈 <b>{symbol}/USD</b> – SMA20 · EMA50 · Bollinger · RSI14 · MACD",
+                   on_render=lambda: bot.send_message(chat_id, f"⏳ Generating {symbol} technical chart..."))
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Chart generation failed: {e}")
 
-    msg = bot.send_message(message.chat.id, "⏳ Loading live market data...", reply_markup=markup)
-
-    def update_live():
-        count = 0
-        while live_sessions.get(uid, False) and count < 60:
-            lines = ["╔══════════════════════════════════╗",
-                      "║  📊 <b>LIVE CRYPTO MARKET</b>          ║",
-                      "╠══════════════════════════════════╣"]
-            for cmd, (sym, _) in CRYPTO_MAP.items():
-                d = get_crypto_price(sym)
-                if d:
-                    e = "🟢" if d["change"] >= 0 else "🔴"
-                    lines.append(f"║  {e} {sym}: ${d['price']:,.2f} ({d['change']:+.2f}%)")
-            lines.append(f"║\n║  🕐 Updated: {datetime.now().strftime('%H:%M:%S')}")
-            lines.append("╚══════════════════════════════════╝")
-            text = "\n".join(lines)
+@bot.message_handler(commands=["chart"])
+def indicator_chart_command(message):
+    ensure_user(message.from_user)
+    if not is_premium(message.from_user.id):
+        bot.reply_to(message, "⭐ Advanced charts are a Premium feature. Use /premium to upgrade!")
+        return
+    parts = message.text.strip().split()
+    cmd = parts[1].lower() if len(parts) > 1 else "btc"
+    if cmd not in CRYPTO_MAP:
+        bot.reply_to(message, f"⚠️ Usage: /chart BTC\nCoins: {', '.join(c.upper() for c in CRYPTO_MAP)}")
+        return
+    _chart_jobs.submit(_indicator_chart_job, message.chat.id, CRYPTO_MAP[cmd][0])
 
-            try:
-                bot.edit_message_text(text, message.chat.id, msg.message_id, reply_markup=markup, parse_mode="HTML")
-            except:
-                pass
-            count += 1
-            time.sleep(5)
+ALERT_USAGE = """⚠️ Usage:
+/alert BTC 65000 - price target
+/alert BTC 5% 1h - ±5% move within 1h (m/h, max 24h)
+/alert BTC trail 3% - trailing stop 3% from peak"""
 
-        live_sessions.pop(uid, None)
-        try:
-            bot.edit_message_text("🛑 Live updates stopped.", message.chat.id, msg.message_id)
-        except:
-            pass
+def _parse_pct(text):
+    try:
+        pct = float(text.rstrip("%"))
+    except ValueError:
+        return None
+    return pct if 0 < pct < 100 else None
 
-    threading.Thread(target=update_live, daemon=True).start()
+def _parse_window(text):
+    text = text.lower()
+    units = {"m": 60, "h": 3600}
+    if len(text) < 2 or text[-1] not in units or not text[:-1].isdigit():
+        return None
+    seconds = int(text[:-1]) * units[text[-1]]
+    return seconds if 0 < seconds <= MAX_ALERT_WINDOW else None
+
+def _insert_alert(user_id, symbol, target, direction, window_sec=None, peak=None):
+    with db_transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO alerts (user_id, symbol, target_price, direction, window_sec, peak) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, symbol, target, direction, window_sec, peak))
+    return cur.lastrowid
+
+def move_alert_command(message, symbol, pct_text, window_text):
+    pct, window_sec = _parse_pct(pct_text), _parse_window(window_text)
+    if pct is None or window_sec is None:
+        bot.reply_to(message, ALERT_USAGE)
+        return
+    data = get_crypto_price(symbol)
+    if not data:
+        bot.reply_to(message, f"❌ Cannot find {symbol}.")
+        return
 
-@bot.message_handler(commands=["price_btc"])
-def btc_chart_command(message):
-    ensure_user(message.from_user)
-    bot.send_message(message.chat.id, "⏳ Generating BTC 7-day chart...")
+    alert_id = _insert_alert(message.from_user.id, symbol, pct, "move", window_sec=window_sec)
+    add_move_alert(alert_id, message.from_user.id, symbol, pct, window_sec)
+    bot.send_message(message.chat.id, f"""
+╔══════════════════════════════════╗
+║  🔔 <b>MOVE ALERT SET</b>               ║
+╠══════════════════════════════════╣
+║  📈 {symbol}/USDT
+║  📍 Move: ±{pct:g}% within {window_text.lower()}
+║  📊 Current: ${data['price']:,.2f}
+╚══════════════════════════════════╝
 
-    try:
-        url = "https://api.coincap.io/v2/assets/bitcoin/history?interval=h1"
-        r = requests.get(url, timeout=15)
-        data = r.json()["data"]
-
-        now = datetime.now()
-        week_ago = now - timedelta(days=7)
-        filtered = [d for d in data if datetime.fromtimestamp(d["time"]/1000) >= week_ago]
-
-        times = [datetime.fromtimestamp(d["time"]/1000) for d in filtered]
-        prices = [float(d["priceUsd"]) for d in filtered]
-
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.plot(times, prices, color="#00ff88", linewidth=2)
-        ax.fill_between(times, prices, alpha=0.15, color="#00ff88")
-        ax.set_facecolor("#0a0a1a")
-        fig.patch.set_facecolor("#0a0a1a")
-        ax.tick_params(colors="white")
-        ax.xaxis.set_major_formatter(mdates.DateFormatter("%b %d"))
-        ax.set_title("Bitcoin 7-Day Price Chart", color="white", fontsize=14, fontweight="bold")
-        ax.set_ylabel("USD", color="white")
-        for spine in ax.spines.values():
-            spine.set_color("#333")
-        ax.grid(True, alpha=0.2, color="#444")
-        plt.tight_layout()
+✅ You'll be notified when {symbol} moves {pct:g}% within {window_text.lower()}
+""")
+
+def trail_alert_command(message, symbol, pct_text):
+    pct = _parse_pct(pct_text)
+    if pct is None:
+        bot.reply_to(message, ALERT_USAGE)
+        return
+    data = get_crypto_price(symbol)
+    if not data:
+        bot.reply_to(message, f"❌ Cannot find {symbol}.")
+        return
 
-        buf = io.BytesIO()
-        plt.savefig(buf, format="png", dpi=150)
-        buf.seek(0)
-        plt.close()
+    alert_id = _insert_alert(message.from_user.id, symbol, pct, "trail", peak=data["price"])
+    add_trail_alert(alert_id, message.from_user.id, symbol, pct, data["price"])
+    bot.send_message(message.chat.id, f"""
+╔══════════════════════════════════╗
+║  🔔 <b>TRAILING STOP SET</b>            ║
+╠══════════════════════════════════╣
+║  📉 {symbol}/USDT
+║  📍 Stop: {pct:g}% below peak
+║  📊 Current: ${data['price']:,.2f}
+╚══════════════════════════════════╝
 
-        bot.send_photo(message.chat.id, buf, caption="📊 <b>BTC/USD - 7 Day Chart</b>", parse_mode="HTML")
-    except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Chart generation failed: {e}")
+✅ You'll be notified when {symbol} falls {pct:g}% from its highest price
+""")
 
 @bot.message_handler(commands=["alert"])
 def alert_command(message):
     ensure_user(message.from_user)
     parts = message.text.strip().split()
+    if len(parts) == 4 and parts[2].lower() == "trail":
+        return trail_alert_command(message, parts[1].upper(), parts[3])
+    if len(parts) == 4:
+        return move_alert_command(message, parts[1].upper(), parts[2], parts[3])
     if len(parts) != 3:
-        bot.reply_to(message, "⚠️ Usage: /alert BTC 65000")
+        bot.reply_to(message, ALERT_USAGE)
         return
 
     symbol = parts[1].upper()
@@ -594,11 +1780,8 @@ def alert_command(message):
 
     direction = "above" if target > data["price"] else "below"
 
-    conn = get_db()
-    conn.execute("INSERT INTO alerts (user_id, symbol, target_price, direction) VALUES (?, ?, ?, ?)",
-                 (message.from_user.id, symbol, target, direction))
-    conn.commit()
-    conn.close()
+    alert_id = _insert_alert(message.from_user.id, symbol, target, direction)
+    add_alert(alert_id, message.from_user.id, symbol, target, direction)
 
     emoji = "🔺" if direction == "above" else "🔻"
     text = f"""
@@ -615,6 +1798,178 @@ def alert_command(message):
 """
     bot.send_message(message.chat.id, text)
 
+# =============================================================================
+# /portfolio - PORTFOLIO TRACKING (Premium)
+# =============================================================================
+# Holdings (user_id, symbol) par amount aur total cost basis (USD). Valuation
+# ke liye saare symbols ek get_crypto_prices batch mein aate hain, phir values
+# NumPy arrays se: value = amount * price, user totals np.bincount se. Kitne bhi
+# users ho, har refresh ek upstream request hai.
+PORTFOLIO_MAX_HOLDINGS = 50
+PORTFOLIO_SNAPSHOT_MINUTES = 60
+PORTFOLIO_SNAPSHOT_RETENTION_DAYS = 90
+PORTFOLIO_USAGE = """⚠️ Usage:
+/portfolio - view holdings & P&L
+/portfolio add BTC 0.5 [buy_price]
+/portfolio remove BTC [amount]"""
+
+def value_holdings(rows):
+    """rows: [(user_id, symbol, amount, cost)]. Lautata hai (per-holding values
+    array, prices {symbol: price}, {user_id: (value, cost)}). Jis symbol ka price
+    nahi mila uski value 0 nahi balki cost maani jaati hai taaki P&L na bigde."""
+    if not rows:
+        return np.array([]), {}, {}
+    users, user_idx = np.unique(np.array([r[0] for r in rows], dtype=np.int64), return_inverse=True)
+    symbols = [r[1] for r in rows]
+    prices = {sym: data["price"] for sym, data in get_crypto_prices(set(symbols)).items()}
+    amounts = np.array([r[2] for r in rows], dtype=float)
+    costs = np.array([r[3] for r in rows], dtype=float)
+    price_arr = np.array([prices.get(sym, np.nan) for sym in symbols])
+    values = np.where(np.isnan(price_arr), costs, amounts * price_arr)
+    total_value = np.bincount(user_idx, weights=values, minlength=len(users))
+    total_cost = np.bincount(user_idx, weights=costs, minlength=len(users))
+    totals = {int(uid): (float(v), float(c)) for uid, v, c in zip(users, total_value, total_cost)}
+    return values, prices, totals
+
+def snapshot_portfolios():
+    rows = get_db().execute("SELECT user_id, symbol, amount, cost FROM holdings").fetchall()
+    _, _, totals = value_holdings([tuple(r) for r in rows])
+    now = time.time()
+    with db_transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO portfolio_snapshots (user_id, taken_at, value, cost) VALUES (?, ?, ?, ?)",
+            [(uid, now, value, cost) for uid, (value, cost) in totals.items()])
+        conn.execute("DELETE FROM portfolio_snapshots WHERE taken_at < ?",
+                     (now - PORTFOLIO_SNAPSHOT_RETENTION_DAYS * 86400,))
+
+def _portfolio_add(message, uid, parts):
+    if len(parts) not in (4, 5):
+        bot.reply_to(message, PORTFOLIO_USAGE)
+        return
+    symbol = parts[2].upper()
+    try:
+        amount = float(parts[3])
+        buy_price = float(parts[4]) if len(parts) == 5 else None
+        # inf/nan float() se nikal jaate hain; DB mein inf ya NOT NULL error na aaye
+        if not math.isfinite(amount) or (buy_price is not None and not math.isfinite(buy_price)):
+            raise ValueError("non-finite number")
+    except ValueError:
+        bot.reply_to(message, "❌ Invalid amount or price.")
+        return
+    if amount <= 0 or (buy_price is not None and buy_price <= 0):
+        bot.reply_to(message, "❌ Amount and price must be positive.")
+        return
+    # Symbol har haal mein market-data hub se validate hota hai, warna custom
+    # price ke saath koi bhi typo holdings mein chala jaata
+    data = get_crypto_price(symbol)
+    if not data:
+        bot.reply_to(message, f"❌ Cannot find {symbol}.")
+        return
+    if buy_price is None:
+        buy_price = data["price"]
+
+    with db_transaction() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM holdings WHERE user_id=? AND symbol != ?", (uid, symbol)).fetchone()[0]
+        full = count >= PORTFOLIO_MAX_HOLDINGS
+        if not full:
+            conn.execute("""
+                INSERT INTO holdings (user_id, symbol, amount, cost) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, symbol) DO UPDATE SET amount = amount + excluded.amount,
+                    cost = cost + excluded.cost, updated_at = CURRENT_TIMESTAMP
+            """, (uid, symbol, amount, amount * buy_price))
+    if full:
+        bot.reply_to(message, f"❌ Max {PORTFOLIO_MAX_HOLDINGS} coins per portfolio.")
+        return
+    bot.reply_to(message, f"✅ Added {amount:g} {symbol} @ ${buy_price:,.2f}")
+
+def _portfolio_remove(message, uid, parts):
+    if len(parts) not in (3, 4):
+        bot.reply_to(message, PORTFOLIO_USAGE)
+        return
+    symbol = parts[2].upper()
+    try:
+        amount = float(parts[3]) if len(parts) == 4 else float("inf")
+        # Bina amount ke inf matlab "sab hatao"; user ka diya inf/nan nahi chalega
+        if len(parts) == 4 and not math.isfinite(amount):
+            raise ValueError("non-finite number")
+    except ValueError:
+        bot.reply_to(message, "❌ Invalid amount.")
+        return
+    if amount <= 0:
+        bot.reply_to(message, "❌ Amount must be positive.")
+        return
+    with db_transaction() as conn:
+        row = conn.execute("SELECT amount, cost FROM holdings WHERE user_id=? AND symbol=?", (uid, symbol)).fetchone()
+        if row and amount >= row["amount"]:
+            conn.execute("DELETE FROM holdings WHERE user_id=? AND symbol=?", (uid, symbol))
+            amount = row["amount"]
+        elif row:
+            # Cost basis proportional kam hota hai (average cost same rehta hai)
+            remaining = row["amount"] - amount
+            conn.execute("UPDATE holdings SET amount=?, cost=?, updated_at=CURRENT_TIMESTAMP WHERE user_id=? AND symbol=?",
+                         (remaining, row["cost"] * remaining / row["amount"], uid, symbol))
+    if not row:
+        bot.reply_to(message, f"❌ {symbol} is not in your portfolio.")
+        return
+    bot.reply_to(message, f"✅ Removed {amount:g} {symbol}")
+
+def _portfolio_view(message, uid):
+    conn = get_db()
+    rows = [tuple(r) for r in conn.execute(
+        "SELECT user_id, symbol, amount, cost FROM holdings WHERE user_id=? ORDER BY symbol", (uid,)).fetchall()]
+    if not rows:
+        bot.reply_to(message, "📂 Your portfolio is empty.\n\n" + PORTFOLIO_USAGE)
+        return
+    values, prices, totals = value_holdings(rows)
+    value, cost = totals[uid]
+    pnl = value - cost
+    lines = []
+    for (_, symbol, amount, hcost), hvalue in zip(rows, values):
+        change = (hvalue / hcost - 1) * 100 if hcost else 0.0
+        emoji = "🟢" if hvalue >= hcost else "🔴"
+        price = f"${prices[symbol]:,.4f}" if symbol in prices else "n/a"
+        lines.append(f"║  {emoji} {amount:g} {symbol} @ {price}\n║     = ${hvalue:,.2f} ({change:+.2f}%)")
+
+    day_ago = conn.execute(
+        "SELECT value FROM portfolio_snapshots WHERE user_id=? AND taken_at <= ? ORDER BY taken_at DESC LIMIT 1",
+        (uid, time.time() - 86400)).fetchone()
+    day_line = ""
+    if day_ago and day_ago["value"]:
+        day_change = value - day_ago["value"]
+        day_line = f"\n║  📅 24h: ${day_change:+,.2f} ({day_change / day_ago['value'] * 100:+.2f}%)"
+
+    holdings = "\n".join(lines)
+    text = f"""
+╔══════════════════════════════════╗
+║  💼 <b>YOUR PORTFOLIO</b>               ║
+╠══════════════════════════════════╣
+{holdings}
+╠══════════════════════════════════╣
+║  💰 Value: ${value:,.2f}
+║  🧾 Cost: ${cost:,.2f}
+║  {"📈" if pnl >= 0 else "📉"} P&L: ${pnl:+,.2f} ({(pnl / cost * 100) if cost else 0:+.2f}%){day_line}
+╚══════════════════════════════════╝
+"""
+    bot.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=["portfolio"])
+def portfolio_command(message):
+    ensure_user(message.from_user)
+    uid = message.from_user.id
+    if not is_premium(uid):
+        bot.reply_to(message, "⭐ Portfolio tracking is a Premium feature. Use /premium to upgrade!")
+        return
+    parts = message.text.strip().split()
+    action = parts[1].lower() if len(parts) > 1 else None
+    if action == "add":
+        _portfolio_add(message, uid, parts)
+    elif action == "remove":
+        _portfolio_remove(message, uid, parts)
+    elif action is None:
+        _portfolio_view(message, uid)
+    else:
+        bot.reply_to(message, PORTFOLIO_USAGE)
+
 # =============================================================================
 # /getcoin - EARN ReCOIN (with real ads from owner)
 # =============================================================================
@@ -629,9 +1984,11 @@ def getcoin_command(message):
 
     conn = get_db()
     today = datetime.now().strftime("%Y-%m-%d")
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
+    # Range compare taake idx_ad_views_user_viewed use ho (date() index use nahi karne deta)
     count = conn.execute(
-        "SELECT COUNT(*) as cnt FROM ad_views WHERE user_id=? AND date(viewed_at)=?",
-        (uid, today)
+        "SELECT COUNT(*) as cnt FROM ad_views WHERE user_id=? AND viewed_at >= ? AND viewed_at < ?",
+        (uid, today, tomorrow)
     ).fetchone()["cnt"]
     conn.close()
 
@@ -731,7 +2088,7 @@ def watch_ad_callback(call):
                         reply_markup=ad_markup)
 
     if ads_count % 2 == 0:
-        add_coins(uid, 1.0)
+        add_coins(uid, 1.0, "ad_reward")
         bot.answer_callback_query(call.id, "🎉 +1 ReCOIN earned!")
         bot.edit_message_text(
             f"✅ <b>+1 ReCOIN earned!</b>\n💎 Balance: {get_balance(uid):.1f} ReCOIN\n\nUse /getcoin to earn more!",
@@ -816,7 +2173,7 @@ def premium_coin_callback(call):
     days = int(parts[3])
     uid = call.from_user.id
 
-    if deduct_coins(uid, cost):
+    if deduct_coins(uid, cost, f"premium_{days}d"):
         set_premium(uid, days)
         bot.answer_callback_query(call.id, f"🎉 Premium activated for {days} days!")
         bot.edit_message_text(
@@ -917,82 +2274,95 @@ def range_callback(call):
     km = float(call.data.split("_")[1])
     session = flight_sessions[uid]
     session["range"] = km
-    session["active"] = True
 
     bot.answer_callback_query(call.id, f"📡 Tracking {km}km range...")
 
     msg = bot.edit_message_text("⏳ Scanning for flights...", call.message.chat.id, call.message.message_id)
 
-    def track_flights():
-        count = 0
-        while flight_sessions.get(uid, {}).get("active", False) and count < 6:
-            lat, lon = session["lat"], session["lon"]
-            deg = km / 111.0
-            lamin, lamax = lat - deg, lat + deg
-            lomin, lomax = lon - deg, lon + deg
+    # Har range tap ka apna job; usi message par dobara tap purane range wala job
+    # band karke naye km ke saath naya job chalata hai
+    job_id = f"flight_{uid}_{msg.message_id}_{uuid.uuid4().hex[:8]}"
+    state = {"count": 0}
 
+    def track_flights():
+        count = state["count"]
+        current = flight_sessions.get(uid, {}).get("job")
+        if current != job_id or count >= 6:
+            cancel_later(job_id)
+            if current == job_id:
+                flight_sessions.pop(uid, None)
+            elif current is not None:
+                return  # naye range ne replace kiya; message ab uska hai
             try:
-                url = f"https://opensky-network.org/api/states/all?lamin={lamin}&lomin={lomin}&lamax={lamax}&lomax={lomax}"
-                r = requests.get(url, timeout=15)
-                data = r.json()
-                states = data.get("states", []) or []
-
-                flights = []
-                for s in states:
-                    if s[5] is not None and s[6] is not None:
-                        dist = geodesic((lat, lon), (s[6], s[5])).km
-                        if dist <= km:
-                            flights.append({
-                                "callsign": (s[1] or "N/A").strip(),
-                                "country": s[2] or "N/A",
-                                "alt": s[7] or 0,
-                                "vel": (s[9] or 0) * 3.6,
-                                "dist": dist
-                            })
-
-                flights.sort(key=lambda x: x["dist"])
-
-                lines = [
-                    "╔══════════════════════════════════╗",
-                    f"║  ✈️ <b>FLIGHTS ({len(flights)} found)</b>",
-                    "╠══════════════════════════════════╣"
-                ]
-
-                if flights:
-                    for i, f in enumerate(flights[:15], 1):
-                        lines.append(f"║ {i}. ✈️ <b>{f['callsign']}</b>")
-                        lines.append(f"║    🌍 {f['country']} | 📏 {f['dist']:.1f}km")
-                        lines.append(f"║    ⬆️ {f['alt']:.0f}m | 💨 {f['vel']:.0f}km/h")
-                        lines.append("║")
-                else:
-                    lines.append("║  No flights in range.")
+                edit_if_changed("🛑 Flight tracking stopped.", call.message.chat.id, msg.message_id)
+            except:
+                pass
+            return
 
-                lines.append(f"║  🕐 {datetime.now().strftime('%H:%M:%S')} | Update {count+1}/6")
-                lines.append("╚══════════════════════════════════╝")
-                text = "\n".join(lines)
+        lat, lon = session["lat"], session["lon"]
+        deg = km / 111.0
+        lamin, lamax = lat - deg, lat + deg
+        lomin, lomax = lon - deg, lon + deg
 
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton("🛑 Stop Tracking", callback_data="stop_flight"))
+        try:
+            url = f"https://opensky-network.org/api/states/all?lamin={lamin}&lomin={lomin}&lamax={lamax}&lomax={lomax}"
+            r = http_get(url, timeout=15, endpoint="opensky.states")
+            data = r.json()
+            states = data.get("states", []) or []
+
+            flights = []
+            for s in states:
+                if s[5] is not None and s[6] is not None:
+                    dist = geodesic((lat, lon), (s[6], s[5])).km
+                    if dist <= km:
+                        flights.append({
+                            "callsign": (s[1] or "N/A").strip(),
+                            "country": s[2] or "N/A",
+                            "alt": s[7] or 0,
+                            "vel": (s[9] or 0) * 3.6,
+                            "dist": dist
+                        })
+
+            flights.sort(key=lambda x: x["dist"])
+
+            lines = [
+                "╔══════════════════════════════════╗",
+                f"║  ✈️ <b>FLIGHTS ({len(flights)} found)</b>",
+                "╠══════════════════════════════════╣"
+            ]
+
+            if flights:
+                for i, f in enumerate(flights[:15], 1):
+                    lines.append(f"║ {i}. ✈️ <b>{f['callsign']}</b>")
+                    lines.append(f"║    🌍 {f['country']} | 📏 {f['dist']:.1f}km")
+                    lines.append(f"║    ⬆️ {f['alt']:.0f}m | 💨 {f['vel']:.0f}km/h")
+                    lines.append("║")
+            else:
+                lines.append("║  No flights in range.")
+
+            lines.append(f"║  🕐 {datetime.now().strftime('%H:%M:%S')} | Update {count+1}/6")
+            lines.append("╚══════════════════════════════════╝")
+            text = "\n".join(lines)
 
-                try:
-                    bot.edit_message_text(text, call.message.chat.id, msg.message_id,
-                                         reply_markup=markup, parse_mode="HTML")
-                except:
-                    pass
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("🛑 Stop Tracking", callback_data="stop_flight"))
 
-            except Exception as e:
-                logger.error(f"Flight tracking error: {e}")
+            try:
+                edit_if_changed(text, call.message.chat.id, msg.message_id,
+                                reply_markup=markup, parse_mode="HTML")
+            except:
+                pass
 
-            count += 1
-            time.sleep(10)
+        except Exception as e:
+            logger.error(f"Flight tracking error: {e}")
 
-        flight_sessions.pop(uid, None)
-        try:
-            bot.edit_message_text("🛑 Flight tracking stopped.", call.message.chat.id, msg.message_id)
-        except:
-            pass
+        state["count"] += 1
 
-    threading.Thread(target=track_flights, daemon=True).start()
+    previous = session.get("job")
+    session["job"] = job_id
+    if previous:
+        cancel_later(previous)
+    run_every(10, track_flights, job_id=job_id)
 
 # =============================================================================
 # STOP HANDLERS
@@ -1000,18 +2370,18 @@ def range_callback(call):
 @bot.callback_query_handler(func=lambda c: c.data == "stop_live")
 def stop_live_callback(call):
     uid = call.from_user.id
-    if uid in live_sessions:
-        live_sessions[uid] = False
+    live_unsubscribe(uid)
     bot.answer_callback_query(call.id, "Live updates stopped.")
-    bot.edit_message_text("🛑 Live updates stopped.", call.message.chat.id, call.message.message_id)
+    edit_if_changed("🛑 Live updates stopped.", call.message.chat.id, call.message.message_id)
 
 @bot.callback_query_handler(func=lambda c: c.data == "stop_flight")
 def stop_flight_callback(call):
     uid = call.from_user.id
-    if uid in flight_sessions:
-        flight_sessions[uid]["active"] = False
+    session = flight_sessions.pop(uid, None)
+    if session and session.get("job"):
+        cancel_later(session["job"])
     bot.answer_callback_query(call.id, "Flight tracking stopped.")
-    bot.edit_message_text("🛑 Flight tracking stopped.", call.message.chat.id, call.message.message_id)
+    edit_if_changed("🛑 Flight tracking stopped.", call.message.chat.id, call.message.message_id)
 
 # =============================================================================
 # OWNER ADS MANAGEMENT
@@ -1550,10 +2920,11 @@ def remove_confirm_yes(call):
     )
     
     total = len(to_remove)
-    success = 0
-    failed = []
-    
-    for i, chat in enumerate(to_remove, 1):
+    result = {"success": 0, "failed": []}
+
+    # Har channel ek deferred job hai – callback thread 1s/channel block nahi hota
+    def leave_step(i):
+        chat = to_remove[i - 1]
         try:
             # Update progress message
             progress = int((i / total) * 20)
@@ -1567,26 +2938,32 @@ def remove_confirm_yes(call):
                 text += f"║  ⏳ Next: {to_remove[i]['title'][:25]}\n"
             text += f"╚══════════════════════════════════╝"
             
-            bot.edit_message_text(text, msg.chat.id, msg.message_id, parse_mode="Markdown")
+            edit_if_changed(text, msg.chat.id, msg.message_id, parse_mode="Markdown")
             
             bot.leave_chat(chat['id'])
-            success += 1
-            time.sleep(1)  # Delay to avoid flood
+            result["success"] += 1
             
         except Exception as e:
-            failed.append(chat['title'])
+            result["failed"].append(chat['title'])
             logger.error(f"Failed to leave {chat['title']}: {e}")
-    
-    # Final report
-    report = f"✅ *Removal Complete*\n"
-    report += f"✓ Successfully left: {success}\n"
-    if failed:
-        report += f"✗ Failed: {', '.join(failed[:3])}"
-        if len(failed) > 3:
-            report += f" and {len(failed)-3} more"
-    
-    bot.edit_message_text(report, msg.chat.id, msg.message_id, parse_mode="Markdown")
-    user_states.pop(f"remove_unknown_{user_id}", None)
+
+        if i < total:
+            run_later(1, leave_step, i + 1)  # Delay to avoid flood
+            return
+
+        # Final report
+        failed = result["failed"]
+        report = f"✅ *Removal Complete*\n"
+        report += f"✓ Successfully left: {result['success']}\n"
+        if failed:
+            report += f"✗ Failed: {', '.join(failed[:3])}"
+            if len(failed) > 3:
+                report += f" and {len(failed)-3} more"
+        
+        edit_if_changed(report, msg.chat.id, msg.message_id, parse_mode="Markdown")
+        user_states.pop(f"remove_unknown_{user_id}", None)
+
+    run_later(0, leave_step, 1)
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("remove_confirm_no_"))
 def remove_confirm_no(call):
@@ -1604,8 +2981,7 @@ def on_bot_added(message):
             conn.close()
             if not row:
                 bot.send_message(message.chat.id, "❌ This group/channel is not whitelisted. Leaving in 2 seconds...")
-                time.sleep(2)
-                bot.leave_chat(message.chat.id)
+                run_later(2, bot.leave_chat, message.chat.id)
 
 # =============================================================================
 # MENU CALLBACKS
@@ -1622,8 +2998,11 @@ def menu_callback(call):
 • /doge - Dogecoin price
 • /sol /xrp /bnb /ada /dot /matic /avax
 • /live - Live all crypto prices
-• /price_btc - 7 day BTC chart
+• /price_btc /price_eth ... - 7 day chart (any coin)
+• /chart BTC - Technical chart (⭐ Premium)
 • /alert BTC 65000 - Set price alert
+• /alert BTC 5% 1h - Alert on ±5% move in 1h
+• /alert BTC trail 3% - Trailing stop from peak
 """)
     elif section == "flight":
         bot.answer_callback_query(call.id)
@@ -1665,7 +3044,7 @@ def givecoin_command(message):
         conn = get_db()
         row = conn.execute("SELECT user_id FROM users WHERE username = ? COLLATE NOCASE", (username,)).fetchone()
         if row:
-            add_coins(row['user_id'], amount)
+            add_coins(row['user_id'], amount, "owner_give")
             bot.reply_to(message, f"✅ {amount} ReCOIN @{username} ko de diye gaye!")
         else:
             bot.reply_to(message, f"❌ User @{username} nahi mila.")
@@ -1692,8 +3071,7 @@ def removecoin_command(message):
         conn = get_db()
         row = conn.execute("SELECT user_id FROM users WHERE username = ? COLLATE NOCASE", (username,)).fetchone()
         if row:
-            conn.execute("UPDATE user_coins SET balance = balance - ? WHERE user_id = ?", (amount, row['user_id']))
-            conn.commit()
+            deduct_coins(row['user_id'], amount, "owner_remove", allow_negative=True)
             bot.reply_to(message, f"✅ {amount} ReCOIN @{username} se kaat liye gaye.")
         else:
             bot.reply_to(message, f"❌ User @{username} nahi mila.")
@@ -1746,8 +3124,7 @@ def removepremium_command(message):
         conn = get_db()
         row = conn.execute("SELECT user_id FROM users WHERE username = ? COLLATE NOCASE", (username,)).fetchone()
         if row:
-            conn.execute("UPDATE users SET is_premium = 0, premium_until = NULL WHERE user_id = ?", (row['user_id'],))
-            conn.commit()
+            remove_premium(row['user_id'])
             bot.reply_to(message, f"✅ @{username} ka premium hata diya gaya.")
         else:
             bot.reply_to(message, f"❌ User @{username} nahi mila.")
@@ -1773,14 +3150,15 @@ def block_user(message):
         conn = get_db()
         # Ensure column exists (should have been added in init_db)
         try:
-            conn.execute("UPDATE users SET blocked = 1 WHERE username = ? COLLATE NOCASE", (username,))
+            cur = conn.execute("UPDATE users SET blocked = 1 WHERE username = ? COLLATE NOCASE", (username,))
         except sqlite3.OperationalError:
             # Column nahi hai to pehle add karo
             conn.execute("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
-            conn.execute("UPDATE users SET blocked = 1 WHERE username = ? COLLATE NOCASE", (username,))
+            cur = conn.execute("UPDATE users SET blocked = 1 WHERE username = ? COLLATE NOCASE", (username,))
         conn.commit()
         
-        if conn.total_changes > 0:
+        # total_changes pooled connection par cumulative hota hai, isliye rowcount dekho
+        if cur.rowcount > 0:
             bot.reply_to(message, f"✅ @{username} ko block kar diya gaya.")
         else:
             bot.reply_to(message, f"❌ @{username} nahi mila.")
@@ -1804,10 +3182,10 @@ def unblock_user(message):
         username = parts[1].replace('@', '')
         
         conn = get_db()
-        conn.execute("UPDATE users SET blocked = 0 WHERE username = ? COLLATE NOCASE", (username,))
+        cur = conn.execute("UPDATE users SET blocked = 0 WHERE username = ? COLLATE NOCASE", (username,))
         conn.commit()
         
-        if conn.total_changes > 0:
+        if cur.rowcount > 0:
             bot.reply_to(message, f"✅ @{username} ka block hata diya gaya.")
         else:
             bot.reply_to(message, f"❌ @{username} nahi mila.")
@@ -1950,9 +3328,12 @@ def resetuser_command(message):
             return
         
         user_id = row['user_id']
-        conn.execute("UPDATE user_coins SET balance = 0 WHERE user_id = ?", (user_id,))
-        conn.execute("UPDATE users SET is_premium = 0, premium_until = NULL WHERE user_id = ?", (user_id,))
+        reset_coins(user_id, "owner_reset")
+        remove_premium(user_id)
         conn.execute("DELETE FROM alerts WHERE user_id = ?", (user_id,))
+        remove_user_alerts(user_id)
+        conn.execute("DELETE FROM holdings WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM portfolio_snapshots WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM ad_views WHERE user_id = ?", (user_id,))
         # Optionally delete links – careful, unke links bhi delete ho jayenge
         # conn.execute("DELETE FROM links WHERE user_id = ?", (user_id,))
@@ -2009,40 +3390,633 @@ def owner_panel_callback(call):
         bot.send_message(call.message.chat.id, "Use /resetuser @username")
         bot.answer_callback_query(call.id)
 
+# =============================================================================
+# NOTIFICATIONS (rate-limited dispatcher)
+# =============================================================================
+# Notifications pehle pending_notifications mein likhe jaate hain, phir workers
+# telegram_limiter se token lekar bhejte hain. Worker kabhi block nahi hota: jis
+# chat ka bucket khaali hai (ya 429 ka global pause chal raha hai) uska item
+# ready time ke saath delayed heap mein jaata hai aur worker agli chat par chala
+# jaata hai. Deliver hone par row batch mein delete hoti hai. Queue bhari ho toh
+# item sirf memory se hat-ta hai – row DB mein pending rehti hai aur requeue job
+# use dobara utha leta hai. attempts bhi DB mein likha jaata hai.
+NOTIFY_WORKERS = 8
+NOTIFY_QUEUE_SIZE = 10_000
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_RETRY_BASE = 5
+
+_notify_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+_notify_delayed = []  # heap: (ready_at, notif_id, item)
+_notify_chat_slots = {}  # chat_id -> aakhri reserved ready time (throttled items line mein lagte hain)
+_notify_inflight = set()
+_notify_done = []
+_notify_lock = threading.Lock()
+_notify_wakeup = threading.Event()
+_notify_pause = {"until": 0.0}
+notify_stats = {"sent": 0, "failed": 0, "rate_limited": 0, "throttled": 0, "retried": 0, "overflow": 0}
+
+def _queue_notifications(rows):
+    with _notify_lock:
+        for row in rows:
+            if row[0] in _notify_inflight:
+                continue
+            if len(_notify_inflight) >= NOTIFY_QUEUE_SIZE:
+                break  # DB mein hai, requeue job baad mein utha lega
+            try:
+                _notify_queue.put_nowait(row)
+            except queue.Full:
+                break
+            _notify_inflight.add(row[0])
+
+def _release_notification(notif_id):
+    """Item memory se hatao, row DB mein pending rehti hai (requeue job ke liye)."""
+    notify_stats["overflow"] += 1
+    with _notify_lock:
+        _notify_inflight.discard(notif_id)
+
+def _defer_notification(item, ready_at):
+    with _notify_lock:
+        heapq.heappush(_notify_delayed, (ready_at, item[0], item))
+    _notify_wakeup.set()
+
+def _throttled_ready_at(chat_id):
+    """Throttled chat ke items ek ke baad ek slots lete hain, sab ek saath wapas nahi aate."""
+    now = time.time()
+    interval = 1 / (TELEGRAM_GROUP_RATE if chat_id < 0 else TELEGRAM_CHAT_RATE)
+    with _notify_lock:
+        if len(_notify_chat_slots) > 10_000:
+            for cid in [c for c, t in _notify_chat_slots.items() if t < now]:
+                del _notify_chat_slots[cid]
+        ready_at = max(now + telegram_limiter.wait_time(chat_id), _notify_chat_slots.get(chat_id, 0) + interval)
+        _notify_chat_slots[chat_id] = ready_at
+    return ready_at
+
+def _notify_scheduler():
+    """Delayed heap se due items ready queue mein (put_nowait – kabhi block nahi)."""
+    while True:
+        now = time.time()
+        due = []
+        with _notify_lock:
+            while _notify_delayed and _notify_delayed[0][0] <= now:
+                due.append(heapq.heappop(_notify_delayed)[2])
+            next_at = _notify_delayed[0][0] if _notify_delayed else None
+        for item in due:
+            try:
+                _notify_queue.put_nowait(item)
+            except queue.Full:
+                _release_notification(item[0])
+        _notify_wakeup.wait(timeout=min(1.0, max(0.01, next_at - now)) if next_at else 1.0)
+        _notify_wakeup.clear()
+
+def persist_notifications(conn, items):
+    """items: [(chat_id, text)] – caller ki transaction mein likhta hai, ids lautata hai."""
+    ids = []
+    for chat_id, text in items:
+        cur = conn.execute("INSERT INTO pending_notifications (chat_id, text) VALUES (?, ?)", (chat_id, text))
+        ids.append((cur.lastrowid, chat_id, text, 0))
+    return ids
+
+def send_notifications(items):
+    with db_transaction() as conn:
+        rows = persist_notifications(conn, items)
+    _queue_notifications(rows)
+
+def requeue_pending_notifications():
+    rows = get_db().execute(
+        "SELECT id, chat_id, text, attempts FROM pending_notifications WHERE attempts < ? ORDER BY id LIMIT ?",
+        (NOTIFY_MAX_ATTEMPTS, NOTIFY_QUEUE_SIZE)
+    ).fetchall()
+    _queue_notifications([tuple(row) for row in rows])
+
+def flush_delivered_notifications():
+    global _notify_done
+    with _notify_lock:
+        if not _notify_done:
+            return
+        done, _notify_done = _notify_done, []
+    try:
+        with db_transaction() as conn:
+            conn.executemany("DELETE FROM pending_notifications WHERE id=?", [(i,) for i in done])
+    except Exception:
+        with _notify_lock:
+            _notify_done.extend(done)  # agli flush mein dobara
+        raise
+    with _notify_lock:
+        _notify_inflight.difference_update(done)
+
+def _notification_finished(notif_id):
+    with _notify_lock:
+        _notify_done.append(notif_id)
+
+def _record_attempt(notif_id, attempts):
+    try:
+        with db_transaction() as conn:
+            conn.execute("UPDATE pending_notifications SET attempts=? WHERE id=?", (attempts, notif_id))
+    except Exception as e:
+        logger.error(f"Could not persist attempts for notification {notif_id}: {e}")
+
+def _notify_worker():
+    while True:
+        item = _notify_queue.get()
+        notif_id, chat_id, text, attempts = item
+        try:
+            if _notify_pause["until"] > time.time():
+                _defer_notification(item, _notify_pause["until"])
+                continue
+            if not telegram_limiter.try_acquire(chat_id):
+                # Is chat ki baari nahi – baaki chats ko rokne ke bajaye baad mein
+                notify_stats["throttled"] += 1
+                _defer_notification(item, _throttled_ready_at(chat_id))
+                continue
+            bot.send_message(chat_id, text)
+            notify_stats["sent"] += 1
+            _notification_finished(notif_id)
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 5)
+                _notify_pause["until"] = max(_notify_pause["until"], time.time() + retry_after)
+                notify_stats["rate_limited"] += 1
+                _defer_notification(item, _notify_pause["until"])
+            else:
+                # 403/400 (bot blocked, chat not found) – retry se kuch nahi badlega
+                notify_stats["failed"] += 1
+                logger.error(f"Notification {notif_id} to {chat_id} dropped: {e}")
+                _notification_finished(notif_id)
+        except Exception as e:
+            attempts += 1
+            if attempts >= NOTIFY_MAX_ATTEMPTS:
+                notify_stats["failed"] += 1
+                logger.error(f"Notification {notif_id} to {chat_id} undelivered after {attempts} attempts: {e}")
+                _notification_finished(notif_id)
+            else:
+                notify_stats["retried"] += 1
+                _record_attempt(notif_id, attempts)
+                _defer_notification((notif_id, chat_id, text, attempts),
+                                    time.time() + NOTIFY_RETRY_BASE * 2 ** (attempts - 1))
+        finally:
+            _notify_queue.task_done()
+
+def notify_metrics():
+    with _notify_lock:
+        delayed = len(_notify_delayed)
+    return {**notify_stats, "queued": _notify_queue.qsize(), "delayed": delayed,
+            "inflight": len(_notify_inflight),
+            "paused_for": max(0.0, round(_notify_pause["until"] - time.time(), 1))}
+
+for _ in range(NOTIFY_WORKERS):
+    threading.Thread(target=_notify_worker, daemon=True).start()
+threading.Thread(target=_notify_scheduler, daemon=True).start()
+requeue_pending_notifications()
+atexit.register(flush_delivered_notifications)
+
 # =============================================================================
 # ALERT CHECKER (Background Job)
 # =============================================================================
-def check_alerts():
-    conn = get_db()
-    alerts = conn.execute("SELECT * FROM alerts WHERE active=1").fetchall()
-    for alert in alerts:
-        data = get_crypto_price(alert["symbol"])
-        if not data:
-            continue
-        triggered = False
-        if alert["direction"] == "above" and data["price"] >= alert["target_price"]:
-            triggered = True
-        elif alert["direction"] == "below" and data["price"] <= alert["target_price"]:
-            triggered = True
-
-        if triggered:
-            conn.execute("UPDATE alerts SET active=0 WHERE id=?", (alert["id"],))
-            conn.commit()
-            text = f"""
+# ----- Alert engine -----
+# Har symbol ke liye do sorted lists: "above" (price >= target par trigger) aur
+# "below" (price <= target). Price update par har side ek bisect se saare crossed
+# alerts mil jaate hain, isliye cost sirf triggered alerts ke hisaab se badhti
+# hai. DB durable source hai; startup par yahin se engine rebuild hota hai.
+# since_ms alert banne ka waqt hai – kline check usse pehle ki wicks ignore karta hai.
+_alert_books = {}  # symbol -> {"above": [(target, id, user_id, since_ms)], "below": [...]}
+_alert_lock = threading.Lock()
+
+# Move ("±5% in 1h") aur trailing ("3% from peak") alerts ke books alag hain;
+# dono har price tick par incrementally update hote hain, history dobara scan
+# nahi hoti. Move alert sirf apne banne (since) ke baad ke prices dekhta hai:
+# jab tak since window ke andar hai alert "young" hai aur apne extremes
+# monotonic deques mein since par bisect se leta hai; window since se aage nikal
+# jaaye toh "mature" list mein chala jaata hai jahan poori window ka high/low
+# aur pct par ek bisect kaafi hai.
+_move_books = {}   # symbol -> {window_sec: {"window": RollingWindow, "alerts": [(pct, id, user_id)],
+                   #                         "young": [(since, pct, id, user_id)]}}
+_trail_books = {}  # symbol -> [[peak, [(pct, id, user_id)]], ...] (peak neeche se upar ghatta hua)
+# Jin groups ka peak last persist ke baad badha; sirf inhi ke alerts DB mein likhe
+# jaate hain. Naya peak hamesha naya group object hai, isliye list order mein
+# baad wala group usi alert ka taaza peak hai.
+_trail_dirty = []
+MAX_ALERT_WINDOW = 24 * 3600
+
+class RollingWindow:
+    """Pichhle window_sec ka min/max. Monotonic deques: har price ek baar andar
+    aur ek baar bahar jaata hai, isliye push amortized O(1) hai."""
+
+    def __init__(self, window_sec):
+        self.window_sec = window_sec
+        self._max = deque()  # (ts, price), price ghatta hua
+        self._min = deque()  # (ts, price), price badhta hua
+
+    def push(self, ts, price):
+        while self._max and self._max[-1][1] <= price:
+            self._max.pop()
+        self._max.append((ts, price))
+        while self._min and self._min[-1][1] >= price:
+            self._min.pop()
+        self._min.append((ts, price))
+        cutoff = ts - self.window_sec
+        while self._max[0][0] < cutoff:
+            self._max.popleft()
+        while self._min[0][0] < cutoff:
+            self._min.popleft()
+
+    def extremes_since(self, since):
+        """(low, high) sirf ts >= since wale prices ka. Monotonic deque mein since ke
+        baad ki pehli entry hi us suffix ka max/min hai."""
+        i = bisect.bisect_left(self._max, since, key=lambda e: e[0])
+        j = bisect.bisect_left(self._min, since, key=lambda e: e[0])
+        if i == len(self._max) or j == len(self._min):
+            return None, None
+        return self._min[j][1], self._max[i][1]
+
+    @property
+    def high(self):
+        return self._max[0][1]
+
+    @property
+    def low(self):
+        return self._min[0][1]
+
+def _alert_book(symbol):
+    book = _alert_books.get(symbol)
+    if book is None:
+        book = _alert_books[symbol] = {"above": [], "below": []}
+    return book
+
+def add_alert(alert_id, user_id, symbol, target, direction, since_ms=None):
+    since_ms = since_ms if since_ms is not None else int(time.time() * 1000)
+    with _alert_lock:
+        bisect.insort(_alert_book(symbol.upper())[direction], (target, alert_id, user_id, since_ms))
+
+def _add_move_alert(symbol, alert_id, user_id, pct, window_sec, since):
+    slot = _move_books.setdefault(symbol, {}).get(window_sec)
+    if slot is None:
+        slot = _move_books[symbol][window_sec] = {"window": RollingWindow(window_sec), "alerts": [], "young": []}
+    if since <= time.time() - window_sec:
+        bisect.insort(slot["alerts"], (pct, alert_id, user_id))
+    else:
+        bisect.insort(slot["young"], (since, pct, alert_id, user_id))
+
+def _trail_push(groups, price):
+    # Jin groups ka peak <= price hai unka naya peak price hai – stack ke upar se
+    # merge karo (peaks neeche se upar strictly ghatte rehte hain)
+    merged = None
+    while groups and groups[-1][0] <= price:
+        alerts = groups.pop()[1]
+        merged = alerts if merged is None else sorted(merged + alerts)
+    if merged is not None:
+        groups.append([price, merged])
+        _trail_dirty.append(groups[-1])
+
+def _add_trail_alert(symbol, alert_id, user_id, pct, peak):
+    groups = _trail_books.setdefault(symbol, [])
+    _trail_push(groups, peak)
+    if groups and groups[-1][0] == peak:
+        bisect.insort(groups[-1][1], (pct, alert_id, user_id))
+    else:
+        groups.append([peak, [(pct, alert_id, user_id)]])
+
+def add_move_alert(alert_id, user_id, symbol, pct, window_sec, since=None):
+    since = since if since is not None else time.time()
+    with _alert_lock:
+        _add_move_alert(symbol.upper(), alert_id, user_id, pct, window_sec, since)
+
+def add_trail_alert(alert_id, user_id, symbol, pct, peak):
+    with _alert_lock:
+        _add_trail_alert(symbol.upper(), alert_id, user_id, pct, peak)
+
+ALERT_COLUMNS = """id, user_id, symbol, target_price, direction, window_sec, peak,
+                   CAST(strftime('%s', created_at) AS INTEGER) * 1000 AS since_ms"""
+
+def load_alerts():
+    rows = get_db().execute(f"SELECT {ALERT_COLUMNS} FROM alerts WHERE active=1").fetchall()
+    books, trails = {}, {}
+    with _alert_lock:
+        _move_books.clear()
+        _trail_books.clear()
+        for row in rows:
+            symbol = row["symbol"].upper()
+            if row["direction"] == "move":
+                _add_move_alert(symbol, row["id"], row["user_id"], row["target_price"], row["window_sec"],
+                                (row["since_ms"] or 0) / 1000)
+            elif row["direction"] == "trail" and row["peak"]:
+                trails.setdefault(symbol, []).append((row["peak"], row["target_price"], row["id"], row["user_id"]))
+            elif row["direction"] in ("above", "below"):
+                book = books.setdefault(symbol, {"above": [], "below": []})
+                book[row["direction"]].append((row["target_price"], row["id"], row["user_id"], row["since_ms"] or 0))
+        for book in books.values():
+            book["above"].sort()
+            book["below"].sort()
+        # Saved peaks seedhe stack mein – _trail_push se dusre alerts ke peaks nahi badalne chahiye
+        for symbol, items in trails.items():
+            groups = _trail_books[symbol] = []
+            for peak, pct, alert_id, user_id in sorted(items, key=lambda t: -t[0]):
+                if groups and groups[-1][0] == peak:
+                    bisect.insort(groups[-1][1], (pct, alert_id, user_id))
+                else:
+                    groups.append([peak, [(pct, alert_id, user_id)]])
+        _alert_books.clear()
+        _alert_books.update(books)
+    logger.info(f"Alert engine loaded: {len(rows)} alerts, {len(books)} symbols")
+
+def restore_alerts(alert_ids):
+    """Engine se nikaale gaye lekin DB mein abhi bhi active alerts wapas books mein."""
+    placeholders = ",".join("?" * len(alert_ids))
+    rows = get_db().execute(
+        f"SELECT {ALERT_COLUMNS} FROM alerts WHERE active=1 AND id IN ({placeholders})", list(alert_ids)
+    ).fetchall()
+    with _alert_lock:
+        for row in rows:
+            symbol = row["symbol"].upper()
+            if row["direction"] == "move":
+                _add_move_alert(symbol, row["id"], row["user_id"], row["target_price"], row["window_sec"],
+                                (row["since_ms"] or 0) / 1000)
+            elif row["direction"] == "trail" and row["peak"]:
+                groups = _trail_books.setdefault(symbol, [])
+                entry = (row["target_price"], row["id"], row["user_id"])
+                # Stack mein peaks neeche se upar ghatte hain – sahi jagah dhoondo
+                i = 0
+                while i < len(groups) and groups[i][0] > row["peak"]:
+                    i += 1
+                if i < len(groups) and groups[i][0] == row["peak"]:
+                    bisect.insort(groups[i][1], entry)
+                else:
+                    groups.insert(i, [row["peak"], [entry]])
+            elif row["direction"] in ("above", "below"):
+                bisect.insort(_alert_book(symbol)[row["direction"]],
+                              (row["target_price"], row["id"], row["user_id"], row["since_ms"] or 0))
+    return len(rows)
+
+def remove_user_alerts(user_id):
+    with _alert_lock:
+        for book in _alert_books.values():
+            for side in ("above", "below"):
+                book[side] = [a for a in book[side] if a[2] != user_id]
+        for slots in _move_books.values():
+            for slot in slots.values():
+                slot["alerts"] = [a for a in slot["alerts"] if a[2] != user_id]
+                slot["young"] = [a for a in slot["young"] if a[3] != user_id]
+        for groups in _trail_books.values():
+            for group in groups:
+                group[1] = [a for a in group[1] if a[2] != user_id]
+
+def threshold_alert_symbols():
+    """Sirf woh symbols jinke above/below book mein alerts hain (kline sweep inhi ka)."""
+    with _alert_lock:
+        return {sym for sym, book in _alert_books.items() if book["above"] or book["below"]}
+
+def alert_symbols():
+    symbols = threshold_alert_symbols()
+    with _alert_lock:
+        symbols |= {sym for sym, slots in _move_books.items()
+                    if any(s["alerts"] or s["young"] for s in slots.values())}
+        symbols |= {sym for sym, groups in _trail_books.items() if any(g[1] for g in groups)}
+        return symbols
+
+def evaluate_alerts(symbol, price):
+    """Crossed alerts engine se nikal kar lautata hai: [(id, user_id, target, direction)]."""
+    with _alert_lock:
+        book = _alert_books.get(symbol)
+        if not book:
+            return []
+        above, below = book["above"], book["below"]
+        n = bisect.bisect_right(above, (price, float("inf")))
+        i = bisect.bisect_left(below, (price, float("-inf")))
+        crossed = [(a[1], a[2], a[0], "above") for a in above[:n]]
+        crossed += [(a[1], a[2], a[0], "below") for a in below[i:]]
+        del above[:n]
+        del below[i:]
+    return crossed
+
+def evaluate_window_alerts(symbol, price, ts=None):
+    """Price ko symbol ke rolling windows aur trailing peaks mein daal kar crossed
+    move/trail alerts nikaalta hai: [(id, user_id, pct, direction)]. Cost har
+    tick par O(windows + peak groups + young alerts + triggered); purane (mature)
+    alerts ki ginti se nahi."""
+    ts = ts if ts is not None else time.time()
+    crossed = []
+    with _alert_lock:
+        for slot in _move_books.get(symbol, {}).values():
+            window = slot["window"]
+            window.push(ts, price)
+            alerts, young = slot["alerts"], slot["young"]
+            # Jin young alerts ka since ab window se bahar hai woh mature
+            k = bisect.bisect_right(young, (ts - window.window_sec, float("inf")))
+            for since, pct, alert_id, user_id in young[:k]:
+                bisect.insort(alerts, (pct, alert_id, user_id))
+            del young[:k]
+            if alerts:
+                move = max(price / window.low - 1, 1 - price / window.high) * 100
+                n = bisect.bisect_right(alerts, (move, float("inf")))
+                crossed += [(a[1], a[2], a[0], "move") for a in alerts[:n]]
+                del alerts[:n]
+            keep = []
+            for entry in young:
+                low, high = window.extremes_since(entry[0])
+                if low is not None and max(price / low - 1, 1 - price / high) * 100 >= entry[1]:
+                    crossed.append((entry[2], entry[3], entry[1], "move"))
+                else:
+                    keep.append(entry)
+            slot["young"] = keep
+        groups = _trail_books.get(symbol)
+        if groups:
+            _trail_push(groups, price)
+            for group in groups:
+                drawdown = (1 - price / group[0]) * 100
+                n = bisect.bisect_right(group[1], (drawdown, float("inf")))
+                crossed += [(a[1], a[2], a[0], "trail") for a in group[1][:n]]
+                del group[1][:n]
+            groups[:] = [g for g in groups if g[1]]
+    return crossed
+
+def persist_trailing_peaks():
+    """Restart ke baad trailing stop apna peak na bhoole. Sirf badhe hue peaks likhe
+    jaate hain, saare trailing alerts nahi."""
+    with _alert_lock:
+        dirty = _trail_dirty[:]
+        _trail_dirty.clear()
+        peaks = {a[1]: group[0] for group in dirty for a in group[1]}
+    if not peaks:
+        return
+    try:
+        with db_transaction() as conn:
+            conn.executemany("UPDATE alerts SET peak=? WHERE id=? AND active=1",
+                             [(peak, alert_id) for alert_id, peak in peaks.items()])
+    except sqlite3.Error as e:
+        logger.error(f"Trailing peaks persist failed: {e}")
+        with _alert_lock:
+            _trail_dirty[:0] = dirty  # agle run mein dobara
+
+def evaluate_alert_candles(symbol, candles):
+    """candles: [(open_ms, high, low)] time order mein. Har alert sirf un candles se
+    check hota hai jo uske since_ms ke baad khuli – jis candle mein alert bana
+    uska pehle wala high/low nahi ginta (baaki minute live snapshot check dekhta
+    hai). Lautata hai [((id, user_id, target, direction), crossing_price)]."""
+    if not candles:
+        return []
+    opens = [c[0] for c in candles]
+    # suffix_high[j] / suffix_low[j] = candles[j:] ka max high / min low
+    suffix_high, suffix_low = [0.0] * len(candles), [0.0] * len(candles)
+    hi, lo = float("-inf"), float("inf")
+    for j in range(len(candles) - 1, -1, -1):
+        hi, lo = max(hi, candles[j][1]), min(lo, candles[j][2])
+        suffix_high[j], suffix_low[j] = hi, lo
+    crossed = []
+    with _alert_lock:
+        book = _alert_books.get(symbol)
+        if not book:
+            return []
+        above, below = book["above"], book["below"]
+        n = bisect.bisect_right(above, (suffix_high[0], float("inf")))
+        i = bisect.bisect_left(below, (suffix_low[0], float("-inf")))
+        keep_above, keep_below = [], []
+        for alert in above[:n]:
+            j = bisect.bisect_left(opens, alert[3])
+            if j < len(candles) and suffix_high[j] >= alert[0]:
+                crossed.append(((alert[1], alert[2], alert[0], "above"), suffix_high[j]))
+            else:
+                keep_above.append(alert)
+        for alert in below[i:]:
+            j = bisect.bisect_left(opens, alert[3])
+            if j < len(candles) and suffix_low[j] <= alert[0]:
+                crossed.append(((alert[1], alert[2], alert[0], "below"), suffix_low[j]))
+            else:
+                keep_below.append(alert)
+        above[:n] = keep_above
+        below[i:] = keep_below
+    return crossed
+
+def _alert_text(symbol, target, direction, price, crossed_at=None):
+    if direction == "move":
+        return f"""
 🚨🚨🚨 <b>PRICE ALERT TRIGGERED!</b> 🚨🚨🚨
 
 ╔══════════════════════════════════╗
-║  💰 {alert['symbol']}/USDT
-║  📍 Target: ${alert['target_price']:,.2f}
-║  📊 Current: ${data['price']:,.4f}
-║  ➡️ {alert['direction'].upper()} target reached!
+║  💰 {symbol}/USDT
+║  📈 Moved ±{target:g}% within window
+║  📊 Current: ${price:,.4f}
+╚══════════════════════════════════╝
+"""
+    if direction == "trail":
+        return f"""
+🚨🚨🚨 <b>TRAILING STOP HIT!</b> 🚨🚨🚨
+
+╔══════════════════════════════════╗
+║  💰 {symbol}/USDT
+║  📉 Dropped {target:g}% from peak
+║  📊 Current: ${price:,.4f}
+╚══════════════════════════════════╝
+"""
+    # Kline sweep se pakdi wick: crossing price alag dikhao, "Current" asli last price hai
+    crossed_line = f"\n║  ⚡ Crossed at: ${crossed_at:,.4f}" if crossed_at is not None else ""
+    return f"""
+🚨🚨🚨 <b>PRICE ALERT TRIGGERED!</b> 🚨🚨🚨
+
+╔══════════════════════════════════╗
+║  💰 {symbol}/USDT
+║  📍 Target: ${target:,.2f}{crossed_line}
+║  📊 Current: ${price:,.4f}
+║  ➡️ {direction.upper()} target reached!
 ╚══════════════════════════════════╝
 """
-            try:
-                bot.send_message(alert["user_id"], text)
-            except:
-                pass
-    conn.close()
+
+def fire_alerts(triggered):
+    """triggered: [((id, user_id, target, direction), symbol, price, crossed_at)] –
+    crossed_at sirf kline sweep wale alerts ke liye, warna None. Deactivation aur
+    notifications ek hi transaction mein, phir dispatcher bhejta hai."""
+    if not triggered:
+        return
+    try:
+        with db_transaction() as conn:
+            conn.executemany("UPDATE alerts SET active=0 WHERE id=?", [(t[0][0],) for t in triggered])
+            rows = persist_notifications(conn, [
+                (user_id, _alert_text(symbol, target, direction, price, crossed_at))
+                for (alert_id, user_id, target, direction), symbol, price, crossed_at in triggered
+            ])
+    except Exception as e:
+        # Books se nikal chuke hain lekin DB mein active – wapas daalo warna restart tak fire nahi honge
+        alert_ids = [t[0][0] for t in triggered]
+        logger.error(f"Alert deactivation failed ({len(alert_ids)} alerts), restoring: {e}")
+        try:
+            restore_alerts(alert_ids)
+        except Exception as e:
+            logger.error(f"Alert restore failed, retrying later: {e}")
+            run_later(5, restore_alerts, alert_ids)
+        return
+    _queue_notifications(rows)
+
+# ----- Kline sweep -----
+# Sirf last price dekhne se polls ke beech ki wick (target chhoo kar wapas) miss
+# ho jaati hai. Har poll par har alerted symbol ki 1m klines pichhle cursor se
+# laate hain aur har candle ka high/low targets se milate hain. Cursor last
+# (abhi khuli) candle ka open time hai, toh woh candle agli baar dobara aati hai
+# aur koi interval chhootta nahi.
+ALERT_POLL_INTERVAL = 60
+KLINE_LIMIT = 1000  # Binance max; itne minutes se purana cursor clamp hota hai
+KLINE_WORKERS = 8
+
+_kline_cursor = {}  # symbol -> next startTime (ms)
+_kline_pool = FuturesThreadPool(max_workers=KLINE_WORKERS, thread_name_prefix="klines")
+
+def _fetch_klines(symbol, start_ms):
+    url = (f"https://api.binance.com/api/v3/klines?symbol={symbol}USDT&interval=1m"
+           f"&startTime={start_ms}&limit={KLINE_LIMIT}")
+    try:
+        r = http_get(url, timeout=10, endpoint="binance.klines")
+        r.raise_for_status()
+        return r.json()
+    except Exception as e:
+        logger.error(f"Kline fetch failed for {symbol}: {e}")
+        return None
+
+def _alert_since(symbol):
+    with _alert_lock:
+        book = _alert_books.get(symbol) or {"above": [], "below": []}
+        return min((a[3] for a in book["above"] + book["below"]), default=None)
+
+def sweep_alert_klines(symbols):
+    """Saare symbols ki klines ek concurrent pass mein. Binance ka klines endpoint
+    multi-symbol nahi leta, isliye fan-out pooled session par hota hai."""
+    now_ms = int(time.time() * 1000)
+    floor_ms = now_ms - KLINE_LIMIT * 60_000
+    starts = {}
+    for symbol in symbols:
+        start = _kline_cursor.get(symbol)
+        if start is None:
+            start = _alert_since(symbol) or now_ms
+        starts[symbol] = max(start, floor_ms)
+    futures = {sym: _kline_pool.submit(_fetch_klines, sym, start) for sym, start in starts.items()}
+
+    triggered = []
+    for symbol, future in futures.items():
+        rows = future.result()
+        if not rows:
+            continue
+        candles = [(int(row[0]), float(row[2]), float(row[3])) for row in rows]
+        triggered += [(alert, symbol, crossed_at) for alert, crossed_at in evaluate_alert_candles(symbol, candles)]
+        _kline_cursor[symbol] = int(rows[-1][0])
+    for symbol in set(_kline_cursor) - set(symbols):
+        _kline_cursor.pop(symbol, None)
+    return triggered
+
+def check_alerts():
+    symbols = alert_symbols()
+    if not symbols:
+        _kline_cursor.clear()
+        return
+    # Move/trail alerts klines se nahi dekhe jaate; unke symbols ke liye request bekaar hai
+    swept = sweep_alert_klines(threshold_alert_symbols())
+    # Klines fail hon toh bhi snapshot price se check ho jaaye
+    prices = get_crypto_prices(tracked_symbols())
+    triggered = [(alert, symbol, prices[symbol]["price"] if symbol in prices else crossed_at, crossed_at)
+                 for alert, symbol, crossed_at in swept]
+    for symbol in symbols:
+        data = prices.get(symbol)
+        if data:
+            crossed = evaluate_alerts(symbol, data["price"]) + evaluate_window_alerts(symbol, data["price"])
+            triggered += [(alert, symbol, data["price"], None) for alert in crossed]
+    fire_alerts(triggered)
+
+load_alerts()
 
 def cleanup_expired_ads():
     conn = get_db()
@@ -2050,6 +4024,229 @@ def cleanup_expired_ads():
     conn.commit()
     conn.close()
 
+# =============================================================================
+# PRICE STREAM (optional WebSocket feed)
+# =============================================================================
+# PRICE_STREAM=1 par Binance ke miniTicker stream se har tick seedha market data
+# hub ke snapshots mein jaata hai, isliye REST polling ki zaroorat nahi padti.
+# Disconnect par backoff ke saath reconnect hota hai aur REST se gap backfill.
+# PRICE_STREAM_URL badal kar local test server se bhi chala sakte hain.
+PRICE_STREAM = os.environ.get("PRICE_STREAM", "0") == "1"
+PRICE_STREAM_URL = os.environ.get("PRICE_STREAM_URL", "wss://stream.binance.com:9443/ws")
+PRICE_STREAM_IDLE_TIMEOUT = 60
+PRICE_STREAM_SUBSCRIBE_CHUNK = 200
+
+stream_stats = {"connected": False, "messages": 0, "reconnects": 0, "last_message_at": None}
+_stream_state = {"ws": None, "subscribed": set(), "next_id": 1}
+_stream_lock = threading.Lock()
+
+def _handle_stream_message(raw):
+    msg = json.loads(raw)
+    data = msg.get("data", msg)  # combined (/stream) aur raw (/ws) dono format
+    if data.get("e") != "24hrMiniTicker":
+        return
+    close, open_ = float(data["c"]), float(data["o"])
+    symbol = data["s"][:-len("USDT")]
+    update_price_snapshot(symbol, {
+        "price": close,
+        "change": (close - open_) / open_ * 100 if open_ else 0.0,
+        "high": float(data["h"]),
+        "low": float(data["l"]),
+        "volume": float(data["v"]),
+    })
+    stream_stats["messages"] += 1
+    stream_stats["last_message_at"] = time.time()
+    # Har tick par bisect – alerts check_alerts ke poll ka wait kiye bina fire hote hain
+    crossed = evaluate_alerts(symbol, close) + evaluate_window_alerts(symbol, close)
+    if crossed:
+        fire_alerts([(alert, symbol, close, None) for alert in crossed])
+
+def _stream_subscribe(ws, symbols):
+    params = [f"{s.lower()}usdt@miniTicker" for s in sorted(symbols)]
+    for i in range(0, len(params), PRICE_STREAM_SUBSCRIBE_CHUNK):
+        with _stream_lock:
+            msg_id = _stream_state["next_id"]
+            _stream_state["next_id"] += 1
+        ws.send(json.dumps({"method": "SUBSCRIBE", "params": params[i:i + PRICE_STREAM_SUBSCRIBE_CHUNK], "id": msg_id}))
+
+def sync_price_stream():
+    """Naye alert symbols ko chalu connection par subscribe karta hai."""
+    wanted = tracked_symbols()
+    with _stream_lock:
+        ws = _stream_state["ws"]
+        if ws is None:
+            return
+        new_symbols = wanted - _stream_state["subscribed"]
+        # Pehle mark karo taaki do syncs same symbols dobara na bhejein; send fail
+        # hua toh connection waise bhi toota hai aur reconnect sab resubscribe karta hai
+        _stream_state["subscribed"] |= new_symbols
+    if new_symbols:
+        _stream_subscribe(ws, new_symbols)
+
+def _price_stream_loop():
+    import websocket  # websocket-client, sirf stream mode mein chahiye
+
+    backoff = 1
+    while True:
+        ws = None
+        try:
+            ws = websocket.create_connection(PRICE_STREAM_URL, timeout=PRICE_STREAM_IDLE_TIMEOUT)
+            symbols = tracked_symbols()
+            # Disconnect ke dauran chhoote ticks ki jagah ek REST batch se state bharo
+            for symbol, data in _fetch_crypto_prices(symbols).items():
+                update_price_snapshot(symbol, data)
+            _stream_subscribe(ws, symbols)
+            with _stream_lock:
+                _stream_state.update(ws=ws, subscribed=set(symbols))
+            stream_stats["connected"] = True
+            backoff = 1
+            while True:
+                raw = ws.recv()
+                if not raw:
+                    raise ConnectionError("stream closed by server")
+                _handle_stream_message(raw)
+        except Exception as e:
+            logger.error(f"Price stream disconnected: {e}")
+        finally:
+            with _stream_lock:
+                _stream_state.update(ws=None, subscribed=set())
+            stream_stats["connected"] = False
+            if ws is not None:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+        stream_stats["reconnects"] += 1
+        time.sleep(backoff + random.uniform(0, backoff / 2))
+        backoff = min(backoff * 2, 60)
+
+def start_price_stream():
+    threading.Thread(target=_price_stream_loop, daemon=True).start()
+    logger.info(f"Price stream started: {PRICE_STREAM_URL}")
+
+# =============================================================================
+# WEBHOOK DEDUP (processed table)
+# =============================================================================
+# Telegram slow delivery par same update dobara bhejta hai. Recent update_ids
+# ek bounded LRU mein hain; DB (processed) mein batch mein likhe jaate hain
+# taake restart ke baad bhi LRU wapas load ho sake.
+PROCESSED_LRU_SIZE = 10_000
+PROCESSED_RETENTION_HOURS = 48
+
+_recent_updates = OrderedDict()
+_pending_processed = []
+_processed_lock = threading.Lock()
+
+def load_recent_updates():
+    rows = get_db().execute(
+        "SELECT update_id FROM processed ORDER BY update_id DESC LIMIT ?", (PROCESSED_LRU_SIZE,)
+    ).fetchall()
+    with _processed_lock:
+        for row in reversed(rows):
+            _recent_updates[row["update_id"]] = True
+
+def mark_update_seen(update_id):
+    """True agar update naya hai, False agar duplicate hai."""
+    if update_id is None:
+        return True
+    with _processed_lock:
+        if update_id in _recent_updates:
+            _recent_updates.move_to_end(update_id)
+            return False
+        _recent_updates[update_id] = True
+        if len(_recent_updates) > PROCESSED_LRU_SIZE:
+            _recent_updates.popitem(last=False)
+        _pending_processed.append((update_id, time.time()))
+    return True
+
+def forget_update(update_id):
+    # Enqueue fail hua to Telegram ke retry ko duplicate mat samjho
+    with _processed_lock:
+        _recent_updates.pop(update_id, None)
+        _pending_processed[:] = [p for p in _pending_processed if p[0] != update_id]
+
+def flush_processed_updates():
+    global _pending_processed
+    with _processed_lock:
+        if not _pending_processed:
+            return
+        batch, _pending_processed = _pending_processed, []
+    with db_transaction() as conn:
+        conn.executemany("INSERT OR IGNORE INTO processed (update_id, processed_at) VALUES (?, ?)", batch)
+
+def prune_processed_updates():
+    cutoff = time.time() - PROCESSED_RETENTION_HOURS * 3600
+    with db_transaction() as conn:
+        conn.execute("DELETE FROM processed WHERE processed_at < ? OR processed_at IS NULL", (cutoff,))
+
+load_recent_updates()
+atexit.register(flush_processed_updates)
+
+# =============================================================================
+# UPDATE DISPATCHER (per-chat ordered worker pool)
+# =============================================================================
+# Webhook turant 200 deta hai aur update ko queue mein daal deta hai. Har chat
+# hamesha ek hi worker (chat_id % UPDATE_WORKERS) par jaata hai, isliye ek chat
+# ke updates order mein chalte hain aur alag chats parallel.
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 500))
+
+_update_queues = [queue.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(UPDATE_WORKERS)]
+dispatch_stats = {"enqueued": 0, "processed": 0, "dropped": 0, "errors": 0}
+_dispatch_lock = threading.Lock()
+
+def _update_chat_id(update):
+    for msg in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if msg:
+            return msg.chat.id
+    if update.callback_query:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    for member in (update.my_chat_member, update.chat_member):
+        if member:
+            return member.chat.id
+    for query in (update.inline_query, update.pre_checkout_query, update.shipping_query):
+        if query:
+            return query.from_user.id
+    return update.update_id
+
+def _bump_dispatch_stat(key):
+    with _dispatch_lock:
+        dispatch_stats[key] += 1
+
+def enqueue_update(update):
+    q = _update_queues[_update_chat_id(update) % UPDATE_WORKERS]
+    try:
+        q.put_nowait(update)
+    except queue.Full:
+        _bump_dispatch_stat("dropped")
+        return False
+    _bump_dispatch_stat("enqueued")
+    return True
+
+def _update_worker(q):
+    while True:
+        update = q.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            _bump_dispatch_stat("errors")
+            logger.error(f"Update {update.update_id} failed: {e}")
+        finally:
+            get_db().close()  # handler ki adhoori transaction next update tak na rahe
+            _bump_dispatch_stat("processed")
+            q.task_done()
+
+def dispatch_metrics():
+    depths = [q.qsize() for q in _update_queues]
+    with _dispatch_lock:
+        stats = dict(dispatch_stats)
+    stats.update({"queue_depth": sum(depths), "max_shard_depth": max(depths), "workers": UPDATE_WORKERS})
+    return stats
+
+for _q in _update_queues:
+    threading.Thread(target=_update_worker, args=(_q,), daemon=True).start()
+
 # =============================================================================
 # FLASK ROUTES
 # =============================================================================
@@ -2237,9 +4434,14 @@ def collect_data(link_id):
 @app.route(WEBHOOK_PATH, methods=["POST"])
 def webhook():
     if request.headers.get("content-type") == "application/json":
-        json_str = request.get_data().decode("utf-8")
-        update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
+        payload = json.loads(request.get_data().decode("utf-8"))
+        if not mark_update_seen(payload.get("update_id")):
+            return "", 200  # Telegram retry – pehle hi process ho chuka
+        update = telebot.types.Update.de_json(payload)
+        if not enqueue_update(update):
+            # Queue full – 503 par Telegram baad mein retry karega
+            forget_update(update.update_id)
+            return "Busy", 503
         return "", 200
     return "Invalid", 403
 
@@ -2249,16 +4451,62 @@ def index():
 
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok", "time": datetime.now().isoformat()})
+    return jsonify({"status": "ok", "time": datetime.now().isoformat(), "dispatch": dispatch_metrics(),
+                    "market_data": market_data_metrics(), "price_stream": stream_stats,
+                    "http": http_metrics(),
+                    "live": {**live_stats, "subscribers": len(live_subscribers)},
+                    "edits": edit_stats, "notifications": notify_metrics(),
+                    "charts": {**chart_stats, "cached": len(_chart_cache), "render": render_metrics()},
+                    "history": history_stats, "indicators": {**indicator_stats, "cached": len(_indicator_cache)}})
 
 # =============================================================================
 # SCHEDULER
 # =============================================================================
-scheduler = BackgroundScheduler()
-scheduler.add_job(check_alerts, "interval", seconds=30)
+scheduler = BackgroundScheduler(
+    executors={"default": ThreadPoolExecutor(int(os.environ.get("SCHEDULER_THREADS", 20)))},
+)
+scheduler.add_job(check_alerts, "interval", seconds=ALERT_POLL_INTERVAL, max_instances=1, coalesce=True)
+scheduler.add_job(live_tick, "interval", seconds=LIVE_TICK, max_instances=1, coalesce=True)
+scheduler.add_job(flush_delivered_notifications, "interval", seconds=1)
+scheduler.add_job(requeue_pending_notifications, "interval", minutes=1)
+scheduler.add_job(persist_trailing_peaks, "interval", minutes=1)
+scheduler.add_job(evict_chart_cache, "interval", minutes=10)
+scheduler.add_job(sync_price_history, "interval", minutes=HISTORY_SYNC_MINUTES, next_run_time=datetime.now())
+scheduler.add_job(prune_price_history, "interval", hours=24)
+scheduler.add_job(snapshot_portfolios, "interval", minutes=PORTFOLIO_SNAPSHOT_MINUTES)
+scheduler.add_job(refresh_market_caps, "interval", seconds=MARKET_CAP_REFRESH, next_run_time=datetime.now())
 scheduler.add_job(cleanup_expired_ads, "interval", minutes=10)
+scheduler.add_job(compact_coin_ledger, "interval", hours=24)
+scheduler.add_job(sweep_expired_premium, "interval", minutes=1)
+scheduler.add_job(flush_processed_updates, "interval", seconds=2)
+scheduler.add_job(prune_processed_updates, "interval", hours=1)
+if PRICE_STREAM:
+    scheduler.add_job(sync_price_stream, "interval", seconds=30)
 scheduler.start()
 
+if PRICE_STREAM:
+    start_price_stream()
+
+# ----- Deferred actions -----
+# Handlers time.sleep ki jagah inhe use karein: delayed send/edit/leave scheduler
+# thread par chalte hain aur job id se cancel ho sakte hain.
+def run_later(delay, func, *args, **kwargs):
+    job = scheduler.add_job(func, "date", run_date=datetime.now() + timedelta(seconds=delay),
+                            args=args, kwargs=kwargs, misfire_grace_time=60)
+    return job.id
+
+def run_every(interval, func, *args, job_id=None, **kwargs):
+    job = scheduler.add_job(func, "interval", seconds=interval, args=args, kwargs=kwargs, id=job_id,
+                            next_run_time=datetime.now(), max_instances=1, coalesce=True)
+    return job.id
+
+def cancel_later(job_id):
+    try:
+        scheduler.remove_job(job_id)
+        return True
+    except JobLookupError:
+        return False
+
 # =============================================================================
 # DEBUG COMMANDS - Remove after testing
 # =============================================================================
@@ -2286,7 +4534,7 @@ def givecoinid_command(message):
             return
         user_id = int(parts[1])
         amount = float(parts[2])
-        add_coins(user_id, amount)
+        add_coins(user_id, amount, "owner_give")
         bot.reply_to(message, f"✅ {amount} ReCOIN given to user {user_id}")
     except Exception as e:
         bot.reply_to(message, f"Error: {e}")